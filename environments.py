@@ -2,6 +2,8 @@ import torch
 
 DATAPATH = "./data"
 DTYPE = torch.float64
+# precision : "mixed" ならデータ行列と P を float32 で持ち, X@x の更新, 損失と差分商は DTYPE で計算する
+PRECISION_DATA_DTYPE = {"double":None,"mixed":torch.float32}
 
 if torch.cuda.is_available():   
     DEVICE = "cuda"
@@ -15,10 +17,16 @@ RESULTPATH = "./results"
 # algorithm name
 RGF = "RGF"
 RSRGF = "proposed"
+NEWTON = "Newton"
+NEWTONCG = "NewtonCG"
+RMM = "ExtendedRMM"
 
 ALGORITHM_PARAMS_KEY = {
-    RGF:["mu","sample_size","lr","central","step_schedule"],
-    RSRGF:["reduced_dim","mu","sample_size","lr","projection","central","step_schedule"]
+    RGF:["mu","sample_size","lr","central","step_schedule","batch","directional","refresh_interval","trial_batch","minibatch_size","minibatch_sampler","snapshot_interval","direction_sampling"],
+    RSRGF:["reduced_dim","mu","sample_size","lr","projection","central","step_schedule","batch","directional","refresh_interval","implicit","chunk_size","sketch","sketch_sparsity","kron_dim","trial_batch","minibatch_size","minibatch_sampler","snapshot_interval","direction_sampling"],
+    NEWTON:["alpha","beta","matrix_free","cg_iteration","cg_tol"],
+    NEWTONCG:["eps","cg_tol","cg_iteration","alpha","beta"],
+    RMM:["c1","c2","r","alpha","beta","matrix_free","cg_iteration","cg_tol","lanczos_iteration"]
 }
 
 # objective name
@@ -38,7 +46,8 @@ SOFTMAX = "softmax"
 ROBUSTLOGISTIC = "robust logistic"
 
 OBJECTIVE_PARAMS_KEY = {
-    SOFTMAX:["data-name"],
-    ROBUSTLOGISTIC:["data-name","inner-iteration","subproblem-eps","delta"],
+    SOFTMAX:["data-name","layout","precision"],
+    ROBUSTLOGISTIC:["data-name","inner-iteration","subproblem-eps","delta","inner-solver","warm-start","subproblem-eps-init","subproblem-eps-decay","layout","precision"],
+    ROBUSTADVERSARIAL:["data-name","inner-iteration","subproblem-eps","delta","inner-solver","warm-start","subproblem-eps-init","subproblem-eps-decay","layout"],
     REGULARIZED:["ord","coef","fused"]
 }
\ No newline at end of file
@@ -2,23 +2,75 @@ from typing import Any
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from solver import BackTrackingPGD,projection_ball2,BackTrackingAccerelatedPGD
+from solver import BackTrackingPGD,projection_ball2,BackTrackingAccerelatedPGD,InnerSolver
+from random_matrix import left_matmul,rows,transpose_matmul,gram,matmul
 from optim_method import logger
+from utils import select_rows
 
 class Function:
+  # data_index : データ行列の params の位置. SetDtype の data_dtype が与えられたらその精度で持つ (混合精度)
+  data_index = []
+  data_dtype = None
+  dtype = None
+
   def __init__(self,params = []):
     self.params = params
     return
 
   def __call__(self,x):
     return
+
+  def batch_call(self,xs):
+    # xs : [batch_size,dim]
+    return torch.stack([self(x) for x in xs])
+
+  def layout(self):
+    # x を行列に reshape して使う関数は各ブロックの形を返す (Noneなら平坦なベクトル)
+    return None
+
+  def set_iteration(self,i):
+    # 外側の反復回数 (内側の問題の許容誤差のスケジュールに使う)
+    return
+
+  def inner_iteration(self):
+    # 内側の問題を解くのに使った反復回数の合計 (内側の問題がなければ None)
+    return None
+
+  # directional oracle : f(x + D@c) をまとめて評価する
+  def set_base_point(self,x,refresh = True):
+    self._base_x_ = x.clone()
+    return
+
+  def move_base_point(self,c):
+    # x <- x + D@c
+    self._base_x_ = self._base_x_ + matmul(self._directions_,c)
+    return
+
+  def set_directions(self,D):
+    # D : [dim,k]
+    self._directions_ = D
+    return
+
+  def base_call(self):
+    return self(self._base_x_)
+
+  def directional_batch_call(self,C):
+    # C : [k,batch_size]
+    xs = (self._base_x_.unsqueeze(1) + matmul(self._directions_,C)).transpose(0,1)
+    return self.batch_call(xs)
   
-  def SetDtype(self,dtype):
+  def SetDtype(self,dtype,data_dtype = None):
     for i in range(len(self.params)):
       try:
-        self.params[i] = self.params[i].to(dtype)
+        if data_dtype is not None and i in self.data_index:
+          self.params[i] = self.params[i].to(data_dtype)
+        else:
+          self.params[i] = self.params[i].to(dtype)
       except:
         print(type(self.params[i]))
+    self.dtype = dtype
+    if data_dtype is not None and len(self.data_index) > 0:
+      self.data_dtype = data_dtype
     return
   
   def SetDevice(self,device):
@@ -29,22 +81,56 @@ class Function:
         print(type(self.params[i]))
     return
 
+  # minibatch oracle : 有限和の目的関数だけ (data_num が None なら使えない)
+  def data_num(self):
+    return None
+
+  def labels(self):
+    # stratified な minibatch のためのクラスラベル
+    return None
+
+  def set_minibatch(self,index):
+    raise ValueError("minibatch is not supported.")
+
+  def clear_minibatch(self):
+    return
+
+  def reset_state(self):
+    # 試行や config をまたいで持ち越さない状態 (minibatch, directional の基点と方向) を消す
+    self.clear_minibatch()
+    self.__dict__.pop("_base_x_",None)
+    self.__dict__.pop("_directions_",None)
+    return
+
 class QuadraticFunction(Function):
   def __call__(self,x):
     Q = self.params[0]
     b = self.params[1]
     return 1/2*(Q@x)@x+b@x
 
+  def batch_call(self,xs):
+    Q = self.params[0]
+    b = self.params[1]
+    return 1/2*torch.sum((xs@Q.transpose(0,1))*xs,dim = 1) + xs@b
+
 class test_function(Function):
   def __call__(self,x):
     return 1/2*x@x
 
+  def batch_call(self,xs):
+    return 1/2*torch.sum(xs*xs,dim = 1)
+
 class max_linear(Function):
   def __call__(self, x):
     A = self.params[0]
     b = self.params[1]
     return torch.max(A@x + b)
 
+  def batch_call(self,xs):
+    A = self.params[0]
+    b = self.params[1]
+    return torch.max(xs@A.transpose(0,1) + b,dim = 1).values
+
 class piecewise_linear(Function):
   def __call__(self,x):
     return torch.abs(1-x[0]) + torch.sum(torch.abs( 1 + x[1:] - 2*x[:-1]))
@@ -56,7 +142,93 @@ class norm_function(Function):
     p = self.params[2]
     return torch.linalg.norm(Q@x - b,ord = p)
 
-class logistic(Function):
+class linear_predictor(Function):
+  # f(x) = loss(X@x) の形の関数. X@x を基点で一度だけ計算し, 摂動は X@D だけで評価する
+  # 基点の移動が D の張る空間内なら X@x も X@D から更新する (refresh で再計算)
+  # 混合精度 (data_dtype) では X@x, X@D の積だけを data_dtype で計算し, 結果と損失は dtype で持つ
+  _margin_updated_ = False
+  data_index = [0]
+  # minibatch : params[0],params[1] を行 index の部分に置きかえる (_full_params_ が全データ)
+  _full_params_ = None
+  _row_data_ = None
+  _minibatch_ = False
+  _row_scale_ = 1
+
+  def data_num(self):
+    X = self.params[0] if self._full_params_ is None else self._full_params_[0]
+    return X.shape[0]
+
+  def set_minibatch(self,index):
+    # 以降の oracle は行 index だけの平均 (和の損失は data_num/len(index) 倍) で評価する
+    if self._full_params_ is None:
+      self._full_params_ = list(self.params)
+      X = self.params[0]
+      # 行を取り出すので CSC は一度だけ CSR にしておく
+      self._row_data_ = X.to_sparse_csr() if X.layout == torch.sparse_csc else X
+    self.params[0] = select_rows(self._row_data_,index)
+    self.params[1] = self._full_params_[1][index]
+    self._row_scale_ = self._row_data_.shape[0]/index.shape[0]
+    self._minibatch_ = True
+    self._margin_updated_ = False
+    return
+
+  def clear_minibatch(self):
+    if self._minibatch_:
+      self.params[0],self.params[1] = self._full_params_[0],self._full_params_[1]
+      self._row_scale_ = 1
+      self._minibatch_ = False
+      self._margin_updated_ = False
+    return
+
+  def reset_state(self):
+    super().reset_state()
+    self.__dict__.pop("_base_margin_",None)
+    self.__dict__.pop("_directions_margin_",None)
+    self._margin_updated_ = False
+    self._full_params_ = None
+    self._row_data_ = None
+    return
+
+  def __margin__(self,V):
+    # V : [dim,k] -> [data_num,...,k]
+    return
+
+  def __loss__(self,a):
+    # a : [data_num,...,batch_size] -> [batch_size]
+    return
+
+  def __cast_margin__(self,V):
+    if self.data_dtype is None:
+      return self.__margin__(V)
+    if isinstance(V,torch.Tensor):
+      V = V.to(self.data_dtype)
+    return self.__margin__(V).to(self.dtype)
+
+  def set_base_point(self,x,refresh = True):
+    super().set_base_point(x,refresh)
+    if refresh or not self._margin_updated_:
+      self._base_margin_ = self.__cast_margin__(x.unsqueeze(1))
+    self._margin_updated_ = False
+    return
+
+  def move_base_point(self,c):
+    super().move_base_point(c)
+    self._base_margin_ = self._base_margin_ + self._directions_margin_@c.unsqueeze(1)
+    self._margin_updated_ = True
+    return
+
+  def set_directions(self,D):
+    super().set_directions(D)
+    self._directions_margin_ = self.__cast_margin__(D)
+    return
+
+  def base_call(self):
+    return self.__loss__(self._base_margin_)[0]
+
+  def directional_batch_call(self,C):
+    return self.__loss__(self._base_margin_ + self._directions_margin_@C)
+
+class logistic(linear_predictor):
   def __call__(self,x):
     # Xの最後には列には1だけのものがある
     # yは-1,1で
@@ -65,12 +237,37 @@ class logistic(Function):
     a = X@x
     return torch.mean(torch.log(1 + torch.exp(-y*a)))
 
-class robust_logistic(Function):
+  def batch_call(self,xs):
+    X = self.params[0]
+    y = self.params[1]
+    # [data_num,batch_size]
+    a = X@xs.transpose(0,1)
+    return torch.mean(torch.log(1 + torch.exp(-y.unsqueeze(1)*a)),dim = 0)
+
+  def __margin__(self,V):
+    X = self.params[0]
+    return left_matmul(X,V)
+
+  def __loss__(self,a):
+    y = self.params[1]
+    return torch.mean(torch.log(1 + torch.exp(-y.unsqueeze(1)*a)),dim = 0)
+
+  def labels(self):
+    return self.params[1] if self._full_params_ is None else self._full_params_[1]
+
+class robust_logistic(linear_predictor):
   # torch.log and torch.exp are bad
-  def __init__(self, params=[],delta = 0.1,inner_iteration = 100000,subproblem_eps = 1e-5):
+  def __init__(self, params=[],delta = 0.1,inner_iteration = 100000,subproblem_eps = 1e-5,inner_solver = "pgd",
+               warm_start = False,subproblem_eps_init = None,subproblem_eps_decay = 0.9):
     self.inner_iteration = inner_iteration
     self.subproblem_eps = subproblem_eps
     self.delta = delta
+    # inner_solver : "pgd" (BackTrackingAccerelatedPGD), "exact" (端点での閉じた形), "verify" (両方を計算して比較)
+    if inner_solver not in ("pgd","exact","verify"):
+      raise ValueError(f"No inner solver {inner_solver} for robust logistic.")
+    self.inner_solver = inner_solver
+    self.inner = InnerSolver(eps = subproblem_eps,iteration = inner_iteration,warm_start = warm_start,
+                             eps_init = subproblem_eps_init,eps_decay = subproblem_eps_decay)
 
     super().__init__(params)
 
@@ -78,62 +275,184 @@ class robust_logistic(Function):
     # Xの最後には列には1だけのものがある
     # yは0,1で
     # noiseは1以外のものに対して
-    
-    func,prox,x0 = self.__set__inner_call__(w=w,u=u)
-    
-    return -self.solve_subproblem(func=func,prox=prox,x0=x0,eps=self.subproblem_eps,iteration=self.inner_iteration)
+    X = self.params[0]
+    return self.__inner_value__(X@w,w=w,u=u)
+
+  def __inner_value__(self,a,w = None,u = None):
+    # 内側の最大化問題の値, a = X@w
+    if self.inner_solver != "pgd":
+      v = w if u is None else u
+      value = self.__exact_inner__(a.unsqueeze(1),self.delta*torch.linalg.norm(v).reshape(1))[0]
+      if self.inner_solver == "exact":
+        return value
+    func,prox,x0,func_grad = self.__set__inner_call__(w=w,u=u,a=a)
+    value_,_ = self.inner.solve(func=func,prox=prox,x0=x0,func_grad=func_grad)
+    pgd_value = -value_
+    if self.inner_solver == "verify":
+      if torch.abs(value - pgd_value) > 1e-6*(1 + torch.abs(value)):
+        logger.info(f"inner value mismatch exact:{value.item()} pgd:{pgd_value.item()}")
+      return value
+    return pgd_value
+
+  def __exact_inner__(self,a,r):
+    # a : [data_num,batch_size], r : [batch_size]
+    # 摂動は s = delta_X@w (projectionなら alpha@u) だけを通して効き, |s| <= r = delta*\|w\|.
+    # s -> mean BCE(sigmoid(a + s),y) は凸なので最大値は端点 s = ±r でとる
+    y = self.params[1].unsqueeze(1).expand_as(a)
+    plus = torch.mean(F.binary_cross_entropy_with_logits(a + r,y,reduction = "none"),dim = 0)
+    minus = torch.mean(F.binary_cross_entropy_with_logits(a - r,y,reduction = "none"),dim = 0)
+    return torch.maximum(plus,minus)
    
-  def __set__inner_call__(self,w,u=None):
+  def __set__inner_call__(self,w,u=None,a=None):
     X = self.params[0]
     data_num,feature_num = X.shape
-    self._a_ = X@w
+    if a is None:
+      a = X@w
+    self._a_ = a
       
     if u is not None:
       # u はmu_k/sqrt{n} u
       def func(x_input):
         return -self.__inner_projection_call__(x_input,u=u)
+      def func_grad(x_input):
+        return self.__inner_value_and_grad__(x_input,v=u)
       def prox(x,t):
         return projection_ball2(x,t,r = self.delta)
-      x0 = torch.zeros(u.shape[0],device=X.device,dtype = X.dtype)
+      x0 = torch.zeros(u.shape[0],device=X.device,dtype = u.dtype)
 
     else:
       def func(x_input):
         return -self.__inner_call__(x_input,w=w)
+      def func_grad(x_input):
+        return self.__inner_value_and_grad__(x_input,v=w)
       
       def prox(x,t):
         return projection_ball2(x,t,r = self.delta)
-      x0 = torch.zeros(feature_num,device=X.device,dtype = X.dtype)
+      x0 = torch.zeros(feature_num,device=X.device,dtype = w.dtype)
     
-    return func,prox,x0
+    return func,prox,x0,func_grad
     
   def __inner_call__(self,delta_X,w):
     y = self.params[1]
     a = self._a_ + delta_X@w
-    return F.binary_cross_entropy(F.sigmoid(a),y)
+    # func_grad (__inner_value_and_grad__) と同じ式で計算する (backtracking で両者の値を比べるため)
+    return F.binary_cross_entropy_with_logits(a,y)
   
   def __inner_projection_call__(self,alpha,u):
     y = self.params[1]
     a = self._a_ + alpha@u
-    return F.binary_cross_entropy(F.sigmoid(a),y)
-  
-  def solve_subproblem(self,func,prox,x0,eps=1e-6,iteration = 10000):
-    solver = BackTrackingAccerelatedPGD(func=func,prox=prox)
-    solver.__iter__(x0=x0,iteration=iteration,eps=eps,restart=True)
-    # logger.info(solver.get_iteration())
-    return solver.get_function_value()
+    return F.binary_cross_entropy_with_logits(a,y)
+
+  def __inner_value_and_grad__(self,z,v):
+    # z -> -mean BCE(sigmoid(a + z@v),y) の値と勾配 (z = delta_X, v = w または z = alpha, v = u)
+    y = self.params[1]
+    a = self._a_ + z@v
+    value = -F.binary_cross_entropy_with_logits(a,y)
+    grad = -torch.mean(torch.sigmoid(a) - y)*v
+    return value,grad
   
-  def solve_subproblem_solution(self,func,prox,x0,eps=1e-6,iteration = 10000):
-    solver = BackTrackingAccerelatedPGD(func=func,prox=prox)
+  def solve_subproblem_solution(self,func,prox,x0,eps=1e-6,iteration = 10000,func_grad = None):
+    solver = BackTrackingAccerelatedPGD(func=func,prox=prox,func_grad=func_grad)
     solver.__iter__(x0=x0,iteration=iteration,eps=eps,restart=True)
     return solver.get_solution()
   
 
-  def get_subproblem_solution(self, w,u = None):
+  def set_iteration(self,i):
+    self.inner.set_iteration(i)
+    return
+
+  def inner_iteration(self):
+    return self.inner.total_iteration
+
+  def reset_state(self):
+    super().reset_state()
+    self.inner.reset()
+    return
+
+  def labels(self):
+    return self.params[1] if self._full_params_ is None else self._full_params_[1]
+
+  def batch_call(self,ws,us = None):
+    if self.inner_solver == "exact":
+      X = self.params[0]
+      v = ws if us is None else us
+      return self.__exact_inner__(X@ws.transpose(0,1),self.delta*torch.linalg.norm(v,dim = 1))
+    if self.inner_solver == "pgd":
+      X = self.params[0]
+      return self.__batched_inner_value__(X@ws.transpose(0,1),ws if us is None else us)
+    if us is None:
+      return torch.stack([self(w) for w in ws])
+    return torch.stack([self(w,u = u) for w,u in zip(ws,us)])
+
+  def __batched_inner_value__(self,a,V):
+    # a : [data_num,batch_size], V : [batch_size,dim] (w または u)
+    # 内側の問題 max_{\|z_j\| <= delta} mean BCE(a_j + z_j@v_j) をまとめて解く
+    y = self.params[1]
+    def func(Z,index):
+      s = torch.sum(Z*V[index],dim = 1)
+      Y = y.unsqueeze(1).expand(-1,index.shape[0])
+      return -torch.mean(F.binary_cross_entropy_with_logits(a[:,index] + s,Y,reduction = "none"),dim = 0)
+    def func_grad(Z,index):
+      V_ = V[index]
+      A = a[:,index] + torch.sum(Z*V_,dim = 1)
+      Y = y.unsqueeze(1).expand(-1,index.shape[0])
+      values = -torch.mean(F.binary_cross_entropy_with_logits(A,Y,reduction = "none"),dim = 0)
+      grads = -torch.mean(torch.sigmoid(A) - Y,dim = 0).unsqueeze(1)*V_
+      return values,grads
+    x0 = torch.zeros_like(V)
+    values,_ = self.inner.solve_batch(func=func,x0=x0,r=self.delta,func_grad=func_grad)
+    return -values
+
+  def __margin__(self,V):
+    X = self.params[0]
+    return left_matmul(X,V)
+
+  def base_call(self):
+    return self.__inner_value__(self._base_margin_[:,0],w=self._base_x_)
+
+  def directional_batch_call(self,C,us = None):
+    # 内側の問題は X@w のみを通して w に依存する (projectionでない場合は delta_X@w も必要)
+    a = self._base_margin_ + self._directions_margin_@C
+    if self.inner_solver == "exact":
+      if us is None:
+        # \|x + D@c\|^2 = \|x\|^2 + 2 (D^T x)@c + c^T (D^T D) c
+        D = self._directions_
+        x = self._base_x_
+        norms = x@x + 2*transpose_matmul(D,x)@C + torch.sum(C*(gram(D).to(C.dtype)@C),dim = 0)
+        r = self.delta*torch.sqrt(torch.clamp(norms,min = 0))
+      else:
+        r = self.delta*torch.linalg.norm(us,dim = 1)
+      return self.__exact_inner__(a,r)
+    if self.inner_solver == "pgd":
+      if us is None:
+        us = self._base_x_.unsqueeze(0) + matmul(self._directions_,C).transpose(0,1)
+      return self.__batched_inner_value__(a,us)
+    values = []
+    for j in range(C.shape[1]):
+      if us is None:
+        w = self._base_x_ + matmul(self._directions_,C[:,j])
+        values.append(self.__inner_value__(a[:,j],w=w))
+      else:
+        values.append(self.__inner_value__(a[:,j],u=us[j]))
+    return torch.stack(values)
 
-    func,prox,x0 = self.__set__inner_call__(w=w,u=u)
-    return self.solve_subproblem_solution(func=func,prox=prox,x0=x0,eps=self.subproblem_eps,iteration=self.inner_iteration)
+  def get_subproblem_solution(self, w,u = None):
+    if self.inner_solver == "exact":
+      X = self.params[0]
+      y = self.params[1]
+      v = w if u is None else u
+      norm = torch.linalg.norm(v)
+      if norm == 0:
+        return torch.zeros_like(v)
+      a = X@w
+      r = self.delta*norm
+      sign = 1 if F.binary_cross_entropy_with_logits(a + r,y) >= F.binary_cross_entropy_with_logits(a - r,y) else -1
+      return sign*self.delta*v/norm
+
+    func,prox,x0,func_grad = self.__set__inner_call__(w=w,u=u)
+    return self.solve_subproblem_solution(func=func,prox=prox,x0=x0,eps=self.subproblem_eps,iteration=self.inner_iteration,func_grad=func_grad)
    
-class softmax(Function):
+class softmax(linear_predictor):
   def __call__(self,x,eps = 1e-12):
     X = self.params[0]
     y = self.params[1]
@@ -146,19 +465,59 @@ class softmax(Function):
     out1 = -Z + eps + sum_Z
     return torch.mean(torch.sum(out1*y,dim = 1))
 
+  def batch_call(self,xs,eps = 1e-12):
+    X = self.params[0]
+    y = self.params[1]
+    data_num,feature_num = X.shape
+    _,class_num = y.shape
+    batch_size = xs.shape[0]
+    W = xs[:,:feature_num*class_num].reshape(batch_size,feature_num,class_num)
+    # X@W for all points in one product : [data_num,batch_size,class_num]
+    W = W.permute(1,0,2).reshape(feature_num,batch_size*class_num)
+    Z = (X@W).reshape(data_num,batch_size,class_num)
+    sum_Z = torch.logsumexp(Z,2)
+    sum_Z = sum_Z.unsqueeze(2)
+    out1 = -Z + eps + sum_Z
+    return torch.mean(torch.sum(out1*y.unsqueeze(1),dim = 2),dim = 0)
+
+  def layout(self):
+    X = self.params[0]
+    y = self.params[1]
+    data_num,feature_num = X.shape
+    _,class_num = y.shape
+    return [(feature_num,class_num),(class_num,)]
+
+  def __margin__(self,V):
+    X = self.params[0]
+    y = self.params[1]
+    _,class_num = y.shape
+    # V[i*class_num + j] は W[i,j] に対応 : [data_num,class_num,k]
+    return left_matmul(X,V,group = class_num)
+
+  def __loss__(self,Z,eps = 1e-12):
+    y = self.params[1]
+    sum_Z = torch.logsumexp(Z,1)
+    sum_Z = sum_Z.unsqueeze(1)
+    out1 = -Z + eps + sum_Z
+    return torch.mean(torch.sum(out1*y.unsqueeze(2),dim = 1),dim = 0)
+
+  def labels(self):
+    y = self.params[1] if self._full_params_ is None else self._full_params_[1]
+    return torch.argmax(y,dim = 1)
+
 class subspace_norm(Function):
   def __call__(self,x):
     r = self.params[0]
     p = self.params[1]
     return torch.linalg.norm(x[:r],ord = p)
   
-  def SetDtype(self,dtype):
+  def SetDtype(self,dtype,data_dtype = None):
     for i in range(len(self.params)):
       if self.params[i] is not None:
         self.params[i] = self.params[i].to(torch.int64)
     return  
 
-class LinearRegression(Function):
+class LinearRegression(linear_predictor):
   def __init__(self, params=[],bias = False):
     super().__init__(params)
     self.bias = bias
@@ -167,9 +526,30 @@ class LinearRegression(Function):
     A = self.params[0]
     b = self.params[1]
     if not self.bias:
-      return torch.linalg.norm(A@x - b)**2
+      return self._row_scale_*torch.linalg.norm(A@x - b)**2
     else:
-      return torch.linalg.norm(A@x[:-1] + x[-1] - b)**2
+      return self._row_scale_*torch.linalg.norm(A@x[:-1] + x[-1] - b)**2
+
+  def batch_call(self,xs):
+    A = self.params[0]
+    b = self.params[1]
+    if not self.bias:
+      R = A@xs.transpose(0,1) - b.unsqueeze(1)
+    else:
+      R = A@xs[:,:-1].transpose(0,1) + xs[:,-1] - b.unsqueeze(1)
+    return self._row_scale_*torch.sum(R**2,dim = 0)
+
+  def __margin__(self,V):
+    A = self.params[0]
+    if not self.bias:
+      return left_matmul(A,V)
+    else:
+      dim = V.shape[0]
+      return left_matmul(A,V) + rows(V,dim-1,dim)
+
+  def __loss__(self,a):
+    b = self.params[1]
+    return self._row_scale_*torch.sum((a - b.unsqueeze(1))**2,dim = 0)
 
 class NMF(Function):
   def __call__(self, x):
@@ -180,9 +560,22 @@ class NMF(Function):
     V = x[height*rank:].reshape(rank,width)
     return torch.linalg.norm(U@V - W)**2
 
+  def batch_call(self,xs):
+    W = self.params[0]
+    height,width = W.shape
+    rank = self.params[1]
+    U = xs[:,:height*rank].reshape(-1,height,rank)
+    V = xs[:,height*rank:].reshape(-1,rank,width)
+    return torch.sum((U@V - W)**2,dim = (1,2))
+
+  def layout(self):
+    W = self.params[0]
+    height,width = W.shape
+    rank = int(self.params[1])
+    return [(height,rank),(rank,width)]
   
-  def SetDtype(self, dtype):
-    super().SetDtype(dtype)
+  def SetDtype(self, dtype,data_dtype = None):
+    super().SetDtype(dtype,data_dtype)
     self.params[1] = self.params[1].to(torch.int32)
     return 
 
@@ -224,67 +617,133 @@ class adversarial(Function):
     self.model = self.model.to(device)
     return super().SetDevice(device)
 
-  def SetDtype(self, dtype):
+  def SetDtype(self, dtype,data_dtype = None):
     self.model = self.model.to(dtype)
     super().SetDtype(dtype)
     self.params[1] = self.params[1].to(torch.int64)
     return
 
 class robust_adversarial(Function):
-  def __init__(self, params=[],delta=0.1,subproblem_eps = 1e-6,inner_iteration =10000):
+  def __init__(self, params=[],delta=0.1,subproblem_eps = 1e-6,inner_iteration =10000,inner_solver = "full",
+               warm_start = False,subproblem_eps_init = None,subproblem_eps_decay = 0.9):
     # params = [X,y]
     super().__init__(params)
     self.subproblem_eps = subproblem_eps
     self.inner_iteration = inner_iteration
     self.delta = delta
+    # inner_solver : "full" (delta_X : [feature_num] で解く), "reduced" (delta_X@W : [class_num] の楕円体上で解く)
+    if inner_solver not in ("full","reduced"):
+      raise ValueError(f"No inner solver {inner_solver} for robust adversarial.")
+    self.inner_solver = inner_solver
+    self.inner = InnerSolver(eps = subproblem_eps,iteration = inner_iteration,warm_start = warm_start,
+                             eps_init = subproblem_eps_init,eps_decay = subproblem_eps_decay)
+
+  def set_iteration(self,i):
+    self.inner.set_iteration(i)
+    return
+
+  def inner_iteration(self):
+    return self.inner.total_iteration
+
+  def reset_state(self):
+    super().reset_state()
+    self.inner.reset()
+    return
     
 
   def __call__(self,x,eps = 1e-12):
+    if self.inner_solver == "reduced":
+      return self.__reduced_call__(x,eps = eps)
     X = self.params[0]
     y = self.params[1]
     data_num,feature_num = X.shape
     _,class_num = y.shape
     
     
+    W = x[:feature_num*class_num].reshape(feature_num,class_num)
+    # X@W は内側の反復の間変わらないので一度だけ計算する (inner_func と同じ値)
+    Z_ = X@W + x[feature_num*class_num:]
+    
     def func(x_input):
-      return -self.inner_func(x_input,x=x)
+      return -self.__class_space_loss__(Z_ + x_input@W,eps = eps)
+
+    def func_grad(x_input):
+      value,g = self.__class_space_value_and_grad__(Z_ + x_input@W,eps = eps)
+      return -value,-(W@g)
     
     def prox(x,t):
       return projection_ball2(x,t,r = self.delta)
     
     x0 = torch.zeros(feature_num,device=X.device,dtype = X.dtype)
-    delta_X = self.solve_subproblem(func=func,prox=prox,x0=x0,eps=self.subproblem_eps,iteration=self.inner_iteration)
+    _,delta_X = self.inner.solve(func=func,prox=prox,x0=x0,func_grad=func_grad)
+    return self.__class_space_loss__(Z_ + delta_X@W,eps = eps)
+
+  def inner_func(self,delta_X,x,eps = 1e-12):
+    X = self.params[0]
+    y = self.params[1]
+    data_num,feature_num = X.shape
+    _,class_num = y.shape
     W = x[:feature_num*class_num].reshape(feature_num,class_num)
     Z_ = X@W
+    # [datanum,classnum]
     delta_Z = delta_X@W
+    # [classnum]
     Z = Z_ + delta_Z + x[feature_num*class_num:]
     sum_Z = torch.logsumexp(Z,1)
     sum_Z = sum_Z.unsqueeze(1)
     out1 = -Z + eps + sum_Z
     return torch.mean(torch.sum(out1*y,dim = 1))
 
-  def inner_func(self,delta_X,x,eps = 1e-12):
+  def __reduced_call__(self,x,eps = 1e-12):
+    # 摂動は delta_X@W = W^T delta_X だけを通して効く.
+    # W^T W = V diag(s^2) V^T とすると {W^T delta_X : \|delta_X\| <= delta} = {V diag(s) alpha : \|alpha\| <= delta}
+    # なので alpha : [class_num] 上の問題を解く (1反復 O(data_num*class_num + class_num^2))
     X = self.params[0]
     y = self.params[1]
     data_num,feature_num = X.shape
     _,class_num = y.shape
     W = x[:feature_num*class_num].reshape(feature_num,class_num)
-    Z_ = X@W
-    # [datanum,classnum]
-    delta_Z = delta_X@W
-    # [classnum]
-    Z = Z_ + delta_Z + x[feature_num*class_num:]
+    Z_ = X@W + x[feature_num*class_num:]
+    eigenvalues,eigenvectors = torch.linalg.eigh(W.transpose(0,1)@W)
+    M = eigenvectors*torch.sqrt(torch.clamp(eigenvalues,min = 0))
+
+    def func(alpha):
+      return -self.__class_space_loss__(Z_ + M@alpha,eps = eps)
+
+    def func_grad(alpha):
+      value,g = self.__class_space_value_and_grad__(Z_ + M@alpha,eps = eps)
+      return -value,-(g@M)
+
+    def prox(alpha,t):
+      return projection_ball2(alpha,t,r = self.delta)
+
+    x0 = torch.zeros(class_num,device=X.device,dtype = X.dtype)
+    _,alpha = self.inner.solve(func=func,prox=prox,x0=x0,func_grad=func_grad)
+    return self.__class_space_loss__(Z_ + M@alpha,eps = eps)
+
+  def __class_space_loss__(self,Z,eps = 1e-12):
+    y = self.params[1]
     sum_Z = torch.logsumexp(Z,1)
     sum_Z = sum_Z.unsqueeze(1)
     out1 = -Z + eps + sum_Z
     return torch.mean(torch.sum(out1*y,dim = 1))
 
-    
+  def __class_space_value_and_grad__(self,Z,eps = 1e-12):
+    # __class_space_loss__ の値と, Z の各行についての勾配のデータ平均 [class_num]
+    y = self.params[1]
+    sum_Z = torch.logsumexp(Z,1)
+    sum_Z = sum_Z.unsqueeze(1)
+    out1 = -Z + eps + sum_Z
+    value = torch.mean(torch.sum(out1*y,dim = 1))
+    G = torch.softmax(Z,1)*torch.sum(y,dim = 1,keepdim = True) - y
+    return value,torch.mean(G,dim = 0)
   
-  def solve_subproblem(self,func,prox,x0,eps=1e-6,iteration = 10000):
-    solver = BackTrackingAccerelatedPGD(func=func,prox=prox)
-    solver.__iter__(x0=x0,iteration=iteration,eps=eps,restart=True)
-    return solver.get_solution()
+  def layout(self):
+    X = self.params[0]
+    y = self.params[1]
+    data_num,feature_num = X.shape
+    _,class_num = y.shape
+    return [(feature_num,class_num),(class_num,)]
 
 class regularizedfunction(Function):
   def __init__(self,f,params):
@@ -301,15 +760,86 @@ class regularizedfunction(Function):
       return self.f(x) + l*torch.linalg.norm(A(x),ord = p)
     else:
       return self.f(x) + l*torch.linalg.norm(x,ord = p)
+
+  def batch_call(self,xs):
+    p = self.params[-3]
+    l = self.params[-2]
+    A = self.params[-1]
+    if A is not None:
+      return super().batch_call(xs)
+    else:
+      return self.f.batch_call(xs) + l*torch.linalg.vector_norm(xs,ord = p.item(),dim = 1)
+
+  def layout(self):
+    return self.f.layout()
+
+  def set_iteration(self,i):
+    self.f.set_iteration(i)
+    return
+
+  def inner_iteration(self):
+    return self.f.inner_iteration()
+
+  def data_num(self):
+    return self.f.data_num()
+
+  def labels(self):
+    return self.f.labels()
+
+  def set_minibatch(self,index):
+    self.f.set_minibatch(index)
+    return
+
+  def clear_minibatch(self):
+    self.f.clear_minibatch()
+    return
+
+  def reset_state(self):
+    super().reset_state()
+    self.f.reset_state()
+    return
+
+  def __regularizer__(self,xs):
+    # xs : [dim,batch_size]
+    p = self.params[-3]
+    l = self.params[-2]
+    A = self.params[-1]
+    if A is not None:
+      xs = A(xs)
+    return l*torch.linalg.vector_norm(xs,ord = p.item(),dim = 0)
+
+  def set_base_point(self,x,refresh = True):
+    super().set_base_point(x,refresh)
+    self.f.set_base_point(x,refresh)
+    return
+
+  def move_base_point(self,c):
+    super().move_base_point(c)
+    self.f.move_base_point(c)
+    return
+
+  def set_directions(self,D):
+    super().set_directions(D)
+    self.f.set_directions(D)
+    return
+
+  def base_call(self):
+    return self.f.base_call() + self.__regularizer__(self._base_x_.unsqueeze(1))[0]
+
+  def directional_batch_call(self,C):
+    xs = self._base_x_.unsqueeze(1) + matmul(self._directions_,C)
+    return self.f.directional_batch_call(C) + self.__regularizer__(xs)
   
   def SetDevice(self, device):
     self.f.SetDevice(device)
     return super().SetDevice(device)
 
-  def SetDtype(self, dtype):
-    self.f.SetDtype(dtype)
+  def SetDtype(self, dtype,data_dtype = None):
+    self.f.SetDtype(dtype,data_dtype)
+    self.data_dtype = self.f.data_dtype
     return super().SetDtype(dtype)
 
+
 class projectionregularizedfunction(regularizedfunction):
   def __call__(self, x,u=None):
     p = self.params[-3]
@@ -319,12 +849,32 @@ class projectionregularizedfunction(regularizedfunction):
       return self.f(x,u) + l*torch.linalg.norm(A(x),ord = p)
     else:
       return self.f(x,u) + l*torch.linalg.norm(x,ord = p)
+
+  def batch_call(self,xs,us = None):
+    p = self.params[-3]
+    l = self.params[-2]
+    A = self.params[-1]
+    if us is None:
+      return super().batch_call(xs)
+    if A is not None:
+      return torch.stack([self(x,u) for x,u in zip(xs,us)])
+    else:
+      return self.f.batch_call(xs,us = us) + l*torch.linalg.vector_norm(xs,ord = p.item(),dim = 1)
+
+  def directional_batch_call(self,C,us = None):
+    if us is None:
+      return super().directional_batch_call(C)
+    xs = self._base_x_.unsqueeze(1) + matmul(self._directions_,C)
+    return self.f.directional_batch_call(C,us = us) + self.__regularizer__(xs)
   
 class CNN_func(Function):
     def __init__(self, params):
       super().__init__(params)
       self.criterion = nn.CrossEntropyLoss()
 
+    def layout(self):
+      return [(16,1*5*5),(16,),(32,16*5*5),(32,),(10,8 * 8 * 32),(10,)]
+
     def __call__(self,x):
       params = 0
       weight1 = x[params:params + 16*1*5*5].reshape(16,1,5,5)
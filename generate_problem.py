@@ -49,8 +49,8 @@ def generate_max_linear(properties):
     filename_b = f"b_{dim}_{number}.pth"
     filename_x0 = f"x0_{dim}_{number}.pth"
     if os.path.exists(os.path.join(savepath,filename_A)):
-        A = torch.load(os.path.join(savepath,filename_A))
-        b = torch.load(os.path.join(savepath,filename_b))
+        A = load_tensor(os.path.join(savepath,filename_A))
+        b = load_tensor(os.path.join(savepath,filename_b))
         x0 = torch.load(os.path.join(savepath,filename_x0))
     else:
         os.makedirs(savepath,exist_ok=True)
@@ -93,8 +93,8 @@ def generate_quadratic(properties):
     filename_b = f"b_{dim}_{rank}.pth"
     filename_x0 = f"x0_{dim}_{rank}.pth"
     if os.path.exists(os.path.join(savepath,filename_Q)):
-        Q = torch.load(os.path.join(savepath,filename_Q))
-        b = torch.load(os.path.join(savepath,filename_b))
+        Q = load_tensor(os.path.join(savepath,filename_Q))
+        b = load_tensor(os.path.join(savepath,filename_b))
         x0 = torch.load(os.path.join(savepath,filename_x0))
         
     else:
@@ -128,8 +128,8 @@ def generate_logistic(properties):
     filename_b = f"b_{dim}_{data_num}.pth"
     filename_x0 = f"x0_{dim}_{data_num}.pth"
     if os.path.exists(os.path.join(savepath,filename_A)):
-        A = torch.load(os.path.join(savepath,filename_A))
-        b = torch.load(os.path.join(savepath,filename_b))
+        A = load_tensor(os.path.join(savepath,filename_A))
+        b = load_tensor(os.path.join(savepath,filename_b))
         x0 = torch.load(os.path.join(savepath,filename_x0))
     else:
         os.makedirs(savepath,exist_ok=True)
@@ -164,13 +164,8 @@ def generate_LinearRegression(properties,local = False):
     data_name = properties["data-name"]
     bias = bool(properties["bias"])
     if data_name == "E2006":
-        from sklearn.datasets import load_svmlight_file
-        from utils import convert_coo_torch
         path_dataset = "./data/LinearRegression/E2006.train.bz2"
-        X,y = load_svmlight_file(path_dataset)
-        X = X.tocoo()
-        X = convert_coo_torch(X)
-        y = torch.from_numpy(y)
+        X,y = load_svmlight_cached(path_dataset,dtype = get_data_dtype(properties),layout = properties.get("layout","auto"))
         dim = X.shape[1]
         if bias:
             dim += 1
@@ -184,16 +179,18 @@ def generate_LinearRegression(properties,local = False):
         dim = 10000
         if bias:
             dim += 1
-        X = torch.load("./data/LinearRegression/random-100-10000-X.pth")
-        y = torch.load("./data/LinearRegression/random-100-10000-y.pth")
+        X = load_tensor("./data/LinearRegression/random-100-10000-X.pth")
+        X = set_layout(X,properties.get("layout","auto"))
+        y = load_tensor("./data/LinearRegression/random-100-10000-y.pth")
         x0 = torch.zeros(dim)
     
     elif data_name == "random-100-100000":
         dim = 100000
         if bias:
             dim += 1
-        X = torch.load("./data/LinearRegression/random-100-100000-X.pth")
-        y = torch.load("./data/LinearRegression/random-100-100000-y.pth")
+        X = load_tensor("./data/LinearRegression/random-100-100000-X.pth")
+        X = set_layout(X,properties.get("layout","auto"))
+        y = load_tensor("./data/LinearRegression/random-100-100000-y.pth")
         x0 = torch.zeros(dim)
         
     else:
@@ -230,13 +227,8 @@ def generate_nmf(properties,local = False):
 def generate_softmax(properties):
     data_name = properties["data-name"]
     if data_name == "Scotus":
-        from sklearn.datasets import load_svmlight_file
-        from utils import convert_coo_torch
         path_dataset = "./data/logistic/scotus_lexglue_tfidf_train.svm.bz2"
-        X,y = load_svmlight_file(path_dataset)
-        X = X.tocoo()
-        X = convert_coo_torch(X)
-        y = torch.from_numpy(y)
+        X,y = load_svmlight_cached(path_dataset,dtype = get_data_dtype(properties),layout = properties.get("layout","auto"))
         y = y.to(torch.int64)
         y=F.one_hot(y)
         data_num,feature_num = X.shape
@@ -244,13 +236,8 @@ def generate_softmax(properties):
         dim = feature_num*class_num + class_num
         x0 = torch.zeros(dim)
     elif data_name == "news20":
-        from sklearn.datasets import load_svmlight_file
-        from utils import convert_coo_torch
         path_dataset = "./data/logistic/news20.bz2"
-        X,y = load_svmlight_file(path_dataset)
-        X = X.tocoo()
-        X = convert_coo_torch(X)
-        y = torch.from_numpy(y)
+        X,y = load_svmlight_cached(path_dataset,dtype = get_data_dtype(properties),layout = properties.get("layout","auto"))
         y = y.to(torch.int64)
         y=F.one_hot(y)
         data_num,feature_num = X.shape
@@ -268,25 +255,13 @@ def generate_adverserial(properties):
     epoch_num = int(properties["epoch-num"])
     coef = torch.tensor(properties["coef"])
     if data_name == "Scotus":
-        from sklearn.datasets import load_svmlight_file
-        from utils import convert_coo_torch
         path_dataset = "./data/logistic/scotus_lexglue_tfidf_train.svm.bz2"
-        X,y = load_svmlight_file(path_dataset)
-        X = X.tocoo()
-        X = convert_coo_torch(X)
-        X = X.to_dense()
-        y = torch.from_numpy(y)
+        X,y = load_svmlight_cached(path_dataset,layout = "dense")
         y = y.to(torch.int64)
 
     elif data_name == "news20":
-        from sklearn.datasets import load_svmlight_file
-        from utils import convert_coo_torch
         path_dataset = "./data/logistic/news20.bz2"
-        X,y = load_svmlight_file(path_dataset)
-        X = X.tocoo()
-        X = convert_coo_torch(X)
-        X = X.to_dense()
-        y = torch.from_numpy(y)
+        X,y = load_svmlight_cached(path_dataset,layout = "dense")
         y = y.to(torch.int64)
     
     params = [X,y,epoch_num,coef]
@@ -295,16 +270,24 @@ def generate_adverserial(properties):
     x0 = torch.ones(features_num)
     return f,x0
 
+def get_data_dtype(properties):
+    # 混合精度ならデータ行列は float32 のキャッシュから直接読む
+    data_dtype = PRECISION_DATA_DTYPE[properties.get("precision","double")]
+    return DTYPE if data_dtype is None else data_dtype
+
+def get_inner_schedule(properties):
+    warm_start = bool(properties.get("warm-start",False))
+    subproblem_eps_init = properties.get("subproblem-eps-init",None)
+    if subproblem_eps_init is not None:
+        subproblem_eps_init = float(subproblem_eps_init)
+    subproblem_eps_decay = float(properties.get("subproblem-eps-decay",0.9))
+    return warm_start,subproblem_eps_init,subproblem_eps_decay
+
 def generate_robust_adversarial(properties):
     data_name = properties["data-name"]
     if data_name == "Scotus":
-        from sklearn.datasets import load_svmlight_file
-        from utils import convert_coo_torch
         path_dataset = "./data/logistic/scotus_lexglue_tfidf_train.svm.bz2"
-        X,y = load_svmlight_file(path_dataset)
-        X = X.tocoo()
-        X = convert_coo_torch(X)
-        y = torch.from_numpy(y)
+        X,y = load_svmlight_cached(path_dataset,dtype = get_data_dtype(properties),layout = properties.get("layout","auto"))
         y = y.to(torch.int64)
         y=F.one_hot(y)
         data_num,feature_num = X.shape
@@ -313,13 +296,8 @@ def generate_robust_adversarial(properties):
         
 
     elif data_name == "news20":
-        from sklearn.datasets import load_svmlight_file
-        from utils import convert_coo_torch
         path_dataset = "./data/logistic/news20.bz2"
-        X,y = load_svmlight_file(path_dataset)
-        X = X.tocoo()
-        X = convert_coo_torch(X)
-        y = torch.from_numpy(y)
+        X,y = load_svmlight_cached(path_dataset,dtype = get_data_dtype(properties),layout = properties.get("layout","auto"))
         y = y.to(torch.int64)
         y=F.one_hot(y)
         data_num,feature_num = X.shape
@@ -331,7 +309,13 @@ def generate_robust_adversarial(properties):
     inner_iteration = int(properties["inner-iteration"])
     subproblem_eps = float(properties["subproblem-eps"])
     delta = float(properties["delta"])
-    f = robust_adversarial(params=params,delta=delta,subproblem_eps=subproblem_eps,inner_iteration=inner_iteration)
+    # None なら問題ごとの既定値
+    inner_solver = properties.get("inner-solver",None)
+    if inner_solver is None:
+        inner_solver = "full"
+    warm_start,subproblem_eps_init,subproblem_eps_decay = get_inner_schedule(properties)
+    f = robust_adversarial(params=params,delta=delta,subproblem_eps=subproblem_eps,inner_iteration=inner_iteration,inner_solver=inner_solver,
+                           warm_start=warm_start,subproblem_eps_init=subproblem_eps_init,subproblem_eps_decay=subproblem_eps_decay)
     return f,x0
 
     
@@ -340,29 +324,20 @@ def generate_robust_logistic(properties):
     if data_name == "rcv1":
         # [20242,47236]
         path_dataset = "./data/logistic/rcv1_train.binary.bz2"
-        from sklearn.datasets import load_svmlight_file
-        from utils import convert_coo_torch
-        X,y = load_svmlight_file(path_dataset)
-        X = X.tocoo()
-        X = convert_coo_torch(X)
-        y = torch.from_numpy(y)
+        X,y = load_svmlight_cached(path_dataset,dtype = get_data_dtype(properties),layout = properties.get("layout","auto"))
         y = (y+1)/2
         y = y.to(torch.int64)
         
     elif data_name == "news20":
         # [19996,1355191]
         path_dataset = "./data/logistic/news20.binary.bz2"
-        from sklearn.datasets import load_svmlight_file
-        from utils import convert_coo_torch
-        X,y = load_svmlight_file(path_dataset)
-        X = X.tocoo()
-        X = convert_coo_torch(X)
-        y = torch.from_numpy(y)
+        X,y = load_svmlight_cached(path_dataset,dtype = get_data_dtype(properties),layout = properties.get("layout","auto"))
         y = (y+1)/2
         y = y.to(torch.int64)
     elif data_name == "random":
-        X = torch.load("./data/logistic/X.pth")
-        y = torch.load("./data/logistic/y.pth")
+        X = load_tensor("./data/logistic/X.pth")
+        X = set_layout(X,properties.get("layout","auto"))
+        y = load_tensor("./data/logistic/y.pth")
         
     data_num,feature_num = X.shape
     params = [X,y]
@@ -370,5 +345,10 @@ def generate_robust_logistic(properties):
     inner_iteration = int(properties["inner-iteration"])
     subproblem_eps = float(properties["subproblem-eps"])
     delta = float(properties["delta"])
-    f = robust_logistic(params=params,delta=delta,inner_iteration=inner_iteration,subproblem_eps=subproblem_eps)
+    inner_solver = properties.get("inner-solver",None)
+    if inner_solver is None:
+        inner_solver = "pgd"
+    warm_start,subproblem_eps_init,subproblem_eps_decay = get_inner_schedule(properties)
+    f = robust_logistic(params=params,delta=delta,inner_iteration=inner_iteration,subproblem_eps=subproblem_eps,inner_solver=inner_solver,
+                        warm_start=warm_start,subproblem_eps_init=subproblem_eps_init,subproblem_eps_decay=subproblem_eps_decay)
     return f,x0
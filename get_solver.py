@@ -23,6 +23,18 @@ def get_determine_step(init_lr,step_schedule):
     else:
         raise ValueError("No step size schedule.")
 
+def get_minibatch(params_json):
+    minibatch_size = params_json.get("minibatch_size",None)
+    if minibatch_size is not None:
+        minibatch_size = int(minibatch_size)
+    minibatch_sampler = params_json.get("minibatch_sampler","uniform")
+    return minibatch_size,minibatch_sampler
+
+def get_snapshot_interval(params_json):
+    snapshot_interval = params_json.get("snapshot_interval",None)
+    if snapshot_interval is None or snapshot_interval == "epoch":
+        return snapshot_interval
+    return int(snapshot_interval)
 
 def get_solver(solver_name,params_json):
     if solver_name == "GD":
@@ -43,10 +55,18 @@ def get_solver(solver_name,params_json):
         sample_size = int(params_json["sample_size"])
         lr = float(params_json["lr"])
         central = bool(params_json["central"])
+        batch = bool(params_json.get("batch",False))
+        directional = bool(params_json.get("directional",False))
+        refresh_interval = int(params_json.get("refresh_interval",100))
+        trial_batch = int(params_json.get("trial_batch",1))
+        minibatch_size,minibatch_sampler = get_minibatch(params_json)
         solver_params = [mu,sample_size,lr]
         step_schedule = params_json["step_schedule"]
         determine_step = get_determine_step(lr,step_schedule)
-        solver = random_gradient_free(determine_step,central)
+        solver = random_gradient_free(determine_step,central,batch=batch,directional=directional,refresh_interval=refresh_interval,trials=trial_batch,
+                                      minibatch_size=minibatch_size,minibatch_sampler=minibatch_sampler,
+                                      snapshot_interval=get_snapshot_interval(params_json),
+                                      direction_sampling=params_json.get("direction_sampling","gaussian"))
     elif solver_name == "OZD":
         mu = float(params_json["mu"])
         sample_size = int(params_json["sample_size"])
@@ -62,10 +82,26 @@ def get_solver(solver_name,params_json):
         lr = float(params_json["lr"])
         central = bool(params_json["central"])
         projection = bool(params_json["projection"])
+        batch = bool(params_json.get("batch",False))
+        directional = bool(params_json.get("directional",False))
+        refresh_interval = int(params_json.get("refresh_interval",100))
+        implicit = bool(params_json.get("implicit",False))
+        chunk_size = int(params_json.get("chunk_size",65536))
+        sketch = params_json.get("sketch","gaussian")
+        sketch_sparsity = int(params_json.get("sketch_sparsity",1))
+        kron_dim = params_json.get("kron_dim",None)
+        if kron_dim is not None:
+            kron_dim = int(kron_dim)
+        trial_batch = int(params_json.get("trial_batch",1))
+        minibatch_size,minibatch_sampler = get_minibatch(params_json)
         solver_params = [reduced_dim,sample_size,mu,lr]
         step_schedule = params_json["step_schedule"]
         determine_step = get_determine_step(lr,step_schedule)
-        solver = proposed(determine_step,central,projection=projection)
+        solver = proposed(determine_step,central,projection=projection,batch=batch,directional=directional,refresh_interval=refresh_interval,
+                          implicit=implicit,chunk_size=chunk_size,sketch=sketch,sparsity=sketch_sparsity,kron_dim=kron_dim,trials=trial_batch,
+                          minibatch_size=minibatch_size,minibatch_sampler=minibatch_sampler,
+                          snapshot_interval=get_snapshot_interval(params_json),
+                          direction_sampling=params_json.get("direction_sampling","gaussian"))
     elif solver_name == "proposed-heuristic":
         reduced_dim = int(params_json["reduced_dim"])
         sample_size = int(params_json["sample_size"])
@@ -86,6 +122,34 @@ def get_solver(solver_name,params_json):
         step_schedule = params_json["step_schedule"]
         determine_step = get_determine_step(lr,step_schedule)
         solver = proposed_sparse(determine_step)
+    elif solver_name == "Newton":
+        alpha = float(params_json["alpha"])
+        beta = float(params_json["beta"])
+        matrix_free = bool(params_json.get("matrix_free",False))
+        cg_iteration = int(params_json.get("cg_iteration",100))
+        cg_tol = float(params_json.get("cg_tol",1e-6))
+        solver_params = [alpha,beta]
+        solver = NewtonMethod(matrix_free=matrix_free,cg_iteration=cg_iteration,cg_tol=cg_tol)
+    elif solver_name == "NewtonCG":
+        eps = float(params_json["eps"])
+        cg_tol = float(params_json["cg_tol"])
+        cg_iteration = int(params_json["cg_iteration"])
+        alpha = float(params_json["alpha"])
+        beta = float(params_json["beta"])
+        solver_params = [eps,cg_tol,cg_iteration,alpha,beta]
+        solver = NewtonCG()
+    elif solver_name == "ExtendedRMM":
+        c1 = float(params_json["c1"])
+        c2 = float(params_json["c2"])
+        r = float(params_json["r"])
+        alpha = float(params_json["alpha"])
+        beta = float(params_json["beta"])
+        matrix_free = bool(params_json.get("matrix_free",False))
+        cg_iteration = int(params_json.get("cg_iteration",100))
+        cg_tol = float(params_json.get("cg_tol",1e-6))
+        lanczos_iteration = int(params_json.get("lanczos_iteration",20))
+        solver_params = [c1,c2,r,alpha,beta]
+        solver = ExtendedRMM(matrix_free=matrix_free,cg_iteration=cg_iteration,cg_tol=cg_tol,lanczos_iteration=lanczos_iteration)
     else:
         raise ValueError("No optimization method.")
 
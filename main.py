@@ -9,90 +9,188 @@ from generate_problem import generate
 from get_solver import get_solver
 import sys
 import logging
-from summarizing.modify_json import get_element_json,save_result_json,count_files
+import multiprocessing
+from summarizing.modify_json import get_element_json,save_result_json,allocate_suffix,append_json_line
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 logger.addHandler(logging.StreamHandler(sys.stdout))
 
+# 並列実行のとき fork で子プロセスに渡す試行の設定 (問題のデータはコピーせずに共有される)
+_TRIAL_ARGS = None
+
+def run_trial(func,x0,solver_name,params_json,iterations,interval,savepath,trial_log = None):
+  # 試行ごとに suffix を確保して solver を新しく作る
+  # trial_log が与えられていれば確保した suffix を記録する (sweep で中断した config の試行だけを消すため)
+  # solver.trials > 1 なら trials 個の試行をまとめて実行する. 戻り値は試行ごとの (save_values,xk) の list
+  # 前の試行や config の状態 (内側の問題の解と warm start, directional や minibatch の状態) を持ち越さない
+  func.reset_state()
+  if func.data_dtype is not None:
+    # 混合精度のデータ行列は directional oracle (X@x と X@P を使い回す) からだけ使う
+    params_json = dict(params_json,directional = True)
+  solver,params = get_solver(solver_name=solver_name,params_json=params_json)
+  if func.data_dtype is not None and not getattr(solver,"directional",False):
+    raise ValueError(f"{solver_name} does not support mixed precision.")
+  solver.device = DEVICE
+  solver.dtype = DTYPE
+  solver.sketch_dtype = func.data_dtype
+  suffixes = [allocate_suffix(savepath,"fvalues",".pth") for _ in range(solver.trials)]
+  if trial_log is not None:
+    for suffix_ in suffixes:
+      append_json_line(trial_log,{"suffix":suffix_})
+  suffix = suffixes[0] if solver.trials == 1 else suffixes
+  x = x0.clone().detach()
+  x.requires_grad_(True)
+  solver.__iter__(func=func,
+                  x0=x,
+                  params=params,
+                  iterations=iterations,
+                  savepath=savepath,
+                  suffix=suffix,
+                  interval=interval)
+  if solver.trials == 1:
+    for k,v in solver.save_values.items():
+      torch.save(v,os.path.join(savepath,k[0]+suffix+".pth"))
+    return [(solver.save_values,solver.xk)]
+  results = []
+  for j,suffix_ in enumerate(suffixes):
+    save_values = {k:v[j] for k,v in solver.save_values.items()}
+    for k,v in save_values.items():
+      torch.save(v,os.path.join(savepath,k[0]+suffix_+".pth"))
+    results.append((save_values,solver.xk[j]))
+  return results
 
+def __init_worker__(threads):
+  torch.set_num_threads(threads)
+  # fork した子プロセスは乱数の状態も同じなので取り直す
+  torch.seed()
+  np.random.seed()
 
-def run(config_name,save_solution = False):
+def __run_trial_worker__(index):
+  return [(save_values,xk.detach()) for save_values,xk in run_trial(*_TRIAL_ARGS)]
+
+
+
+def load_config(config_name):
   if not os.path.exists(os.path.join(CONFIGPATH,config_name)):
     raise ValueError("No config")
 
   with open(os.path.join(CONFIGPATH,config_name)) as f:
     config = json.load(f)
+  return config
 
-  problem = config["problem"]
-  properties = config["properties"]
-  solver_name = config["solver"]
-  params_json = config["params"]
-
-
+def build_problem(problem,properties):
   func,x0 = generate(mode = problem,properties = properties)
-
-  solver,params = get_solver(solver_name=solver_name,params_json=params_json)
-  solver.device = DEVICE
-  solver.dtype = DTYPE
-
-  iterations = int(config["iterations"])
-  interval = int(config["interval"])
-  trial_numbers = config["trial_numbers"]
-
-
   func.SetDevice(DEVICE)
-  func.SetDtype(DTYPE)
-
+  func.SetDtype(DTYPE,data_dtype = PRECISION_DATA_DTYPE[properties.get("precision","double")])
   x0 = x0.to(DTYPE).to(DEVICE)
+  return func,x0
+
+def run(config_name,save_solution = False):
+  config = load_config(config_name)
+  func,x0 = build_problem(config["problem"],config["properties"])
+  run_config(config,func,x0,save_solution = save_solution)
+
+def run_many(config_names,save_solution = False,on_start = None,on_finish = None,on_error = None):
+  # (problem,properties) が同じ config をまとめ, 問題 (データの読み込みと Function) は一度だけ作る
+  # on_start(config_name,config), on_finish(config_name,config) : 各 config の実行の前と後に呼ぶ
+  # on_error(config_name,config,e) : 与えられていれば config ごとに例外を渡して残りの config を続ける (なければ例外を投げる)
+  groups = {}
+  for config_name in config_names:
+    config = load_config(config_name)
+    key = json.dumps([config["problem"],config["properties"]],sort_keys = True)
+    groups.setdefault(key,[]).append((config_name,config))
+  for group in groups.values():
+    try:
+      func,x0 = build_problem(group[0][1]["problem"],group[0][1]["properties"])
+    except Exception as e:
+      if on_error is None:
+        raise
+      for config_name,config in group:
+        on_error(config_name,config,e)
+      continue
+    for config_name,config in group:
+      try:
+        if on_start is not None:
+          on_start(config_name,config)
+        run_config(config,func,x0,save_solution = save_solution)
+      except Exception as e:
+        if on_error is None:
+          raise
+        on_error(config_name,config,e)
+        continue
+      if on_finish is not None:
+        on_finish(config_name,config)
+
+def get_savepath(config):
+  # 結果を保存する場所 results/problem/problem_parameters/solver/solver_parameters
   problem_dir = ""
   solver_dir = ""
-  for k,v in properties.items():
+  for k,v in config["properties"].items():
     if v is not None:
       problem_dir += k + ":" + str(v) + "_"
   problem_dir = problem_dir[:-1]
 
-  for k,v in params_json.items():
+  for k,v in config["params"].items():
     if v is not None:
       solver_dir += k + ":" + str(v) + "_"
   solver_dir = solver_dir[:-1]
-  savepath = os.path.join(RESULTPATH,problem,problem_dir,solver_name,solver_dir)
+  return os.path.join(RESULTPATH,config["problem"],problem_dir,config["solver"],solver_dir)
+
+def run_config(config,func,x0,save_solution = False):
+  solver_name = config["solver"]
+  params_json = config["params"]
+
+  iterations = int(config["iterations"])
+  interval = int(config["interval"])
+  trial_numbers = config["trial_numbers"]
+  workers = int(config.get("workers",1))
+  threads = config.get("threads",None)
+  trial_log = config.get("trial_log",None)
+
+  savepath = get_savepath(config)
   logger.info(savepath)
   os.makedirs(savepath,exist_ok= True)
-  for i in range(trial_numbers):
-    count = count_files(savepath,r"fvalues.*\.pth")
-    if count == 0:
-      suffix = ""
-    else:
-      suffix = str(count)
-    x = x0.clone().detach()
-    x.requires_grad_(True)
-    solver.__iter__(func=func,
-                    x0=x,
-                    params=params,
-                    iterations=iterations,
-                    savepath=savepath,
-                    suffix=suffix,
-                    interval=interval)
+  trial_args = (func,x0,solver_name,params_json,iterations,interval,savepath,trial_log)
+  if workers > 1 and (DEVICE != "cpu" or "fork" not in multiprocessing.get_all_start_methods()):
+    logger.info("parallel trials need fork on cpu, run sequentially")
+    workers = 1
+
+  # trial_batch 個ずつまとめて実行する solver は ceil(trial_numbers/trial_batch) 回呼ぶ
+  trial_batch = int(params_json.get("trial_batch",1))
+  runs = -(-trial_numbers//trial_batch)
+
+  def results():
+    if workers == 1:
+      for i in range(runs):
+        for result in run_trial(*trial_args):
+          yield result
+      return
+    global _TRIAL_ARGS
+    _TRIAL_ARGS = trial_args
+    # fork した worker は親のページ (mmap したデータはページキャッシュ) をそのまま共有する. データは書きかえないのでコピーは起きない
+    num_threads = int(threads) if threads is not None else max(1,os.cpu_count()//workers)
+    with multiprocessing.get_context("fork").Pool(workers,initializer=__init_worker__,initargs=(num_threads,)) as pool:
+      for run_results in pool.imap_unordered(__run_trial_worker__,range(runs)):
+        for result in run_results:
+          yield result
+
+  # result.json は親プロセスだけが書く
+  for save_values,xk in results():
     logger.info(f"{iterations}")
-    values_dict = get_element_json(solver.save_values)
+    values_dict = get_element_json(save_values)
     for k,v in values_dict.items():
       logger.info(f"{k}:{v}")
+    if trial_log is not None:
+      append_json_line(trial_log,{"iteration":iterations,"result":values_dict})
     save_result_json(os.path.join(savepath,"result.json"),values_dict,iterations)
-    for k,v in solver.save_values.items():
-      torch.save(v,os.path.join(savepath,k[0]+suffix+".pth"))
   
   # 最後の反復の結果だけ保存
   if save_solution:
-    torch.save(solver.xk,os.path.join(savepath,"solution.pth"))
+    torch.save(xk,os.path.join(savepath,"solution.pth"))
   fvalues = None
   timevalues = None
-  count = count_files(savepath,r"fvalues.*\.pth")
-  if count == 0:
-    suffix = ""
-  else:
-    suffix = str(count)
-  for k,v in solver.save_values.items():
+  for k,v in save_values.items():
     if k[0] == "fvalues":
       fvalues = v
     if k[0] == "time_values":
@@ -112,5 +210,8 @@ def run(config_name,save_solution = False):
 if __name__ == "__main__":
   import sys
   args = sys.argv
-  config_name = args[1]
-  run(config_name)
\ No newline at end of file
+  if len(args) > 2:
+    run_many(args[1:])
+  else:
+    config_name = args[1]
+    run(config_name)
\ No newline at end of file
@@ -27,6 +27,15 @@ epoch_num = None
 inner_iteration = 1000000
 subproblem_eps = 1e-7
 delta = 1e-3
+# robust logistic : "pgd","exact","verify" / robust adversarial : "full","reduced" (None なら robust logistic は "pgd", robust adversarial は "full")
+inner_solver = None
+warm_start = True
+subproblem_eps_init = 1e-3
+subproblem_eps_decay = 0.99
+# データの形式 : "auto","dense","csr","csc","coo"
+layout = "auto"
+# "double" / "mixed" (データ行列と P を float32 にする. directional で実行される)
+precision = "double"
 
 
 
@@ -37,15 +46,48 @@ reduced_dim = 10
 mu = 1e-8
 sample_size = 10
 central = True
+batch = True
+directional = False
+refresh_interval = 100
+implicit = False
+chunk_size = 65536
+sketch = "gaussian"
+sketch_sparsity = 1
+kron_dim = None
+# trial_batch 個の試行を xk : [trial_batch,dim] としてまとめて実行する
+trial_batch = 1
+# minibatch_size 行ずつの minibatch oracle (None なら全データ). sampler : "uniform","stratified","epoch"
+minibatch_size = None
+minibatch_sampler = "uniform"
+# 分散減少 (SVRG 型) の snapshot の間隔 (None なら使わない, "epoch" なら 1 epoch)
+snapshot_interval = None
+# RGF の P, proposed の U の選び方 : "gaussian","orthogonal","antithetic","sobol"
+direction_sampling = "gaussian"
+
+# second order method
+alpha = 0.3
+beta = 0.8
+eps = 1e-6
+c1 = 2
+c2 = 1
+r = 0.5
+matrix_free = True
+cg_iteration = 100
+cg_tol = 1e-6
+lanczos_iteration = 20
 
 
 iterations =10000
 interval = 10
 trial_numbers = 1
+# trial を並列に実行するプロセス数と各プロセスのスレッド数 (Noneなら cpu数/workers)
+workers = 1
+threads = None
 count = 0
 step_schedule = "constant"
 
-if __name__ == "__main__":     
+def make_config_json():
+    # 上の設定から config.json の中身を作る (sweep.py の base にも使う)
     config_json = {
         "problem":problem,
         "properties" : {},
@@ -69,7 +111,13 @@ if __name__ == "__main__":
           "epoch-num":epoch_num,
           "inner-iteration":inner_iteration,
           "subproblem-eps":subproblem_eps,
-          "delta":delta
+          "delta":delta,
+          "inner-solver":inner_solver,
+          "warm-start":warm_start,
+          "subproblem-eps-init":subproblem_eps_init,
+          "subproblem-eps-decay":subproblem_eps_decay,
+          "layout":layout,
+          "precision":precision
       }
       ,
       "solver":solver_name,
@@ -81,11 +129,36 @@ if __name__ == "__main__":
           "mu":mu,
           "step_schedule":step_schedule,
           "central":central,
-          "projection":projection
+          "projection":projection,
+          "batch":batch,
+          "directional":directional,
+          "refresh_interval":refresh_interval,
+          "implicit":implicit,
+          "chunk_size":chunk_size,
+          "sketch":sketch,
+          "sketch_sparsity":sketch_sparsity,
+          "kron_dim":kron_dim,
+          "trial_batch":trial_batch,
+          "minibatch_size":minibatch_size,
+          "minibatch_sampler":minibatch_sampler,
+          "snapshot_interval":snapshot_interval,
+          "direction_sampling":direction_sampling,
+          "alpha":alpha,
+          "beta":beta,
+          "eps":eps,
+          "c1":c1,
+          "c2":c2,
+          "r":r,
+          "matrix_free":matrix_free,
+          "cg_iteration":cg_iteration,
+          "cg_tol":cg_tol,
+          "lanczos_iteration":lanczos_iteration
       },
       "iterations":iterations,
       "interval":interval,
-      "trial_numbers":trial_numbers
+      "trial_numbers":trial_numbers,
+      "workers":workers,
+      "threads":threads
     }
     
     if REGULARIZED in problem:
@@ -102,8 +175,13 @@ if __name__ == "__main__":
     
     for key in ALGORITHM_PARAMS_KEY[solver_name]:
         config_json["params"][key] = all_config_json["params"][key]
-    
-    
+
+    for key in ["iterations","interval","trial_numbers","workers","threads"]:
+        config_json[key] = all_config_json[key]
+    return config_json
+
+if __name__ == "__main__":
+    config_json = make_config_json()
     with open(os.path.join(CONFIGPATH,config_name),"w") as f:
         json.dump(config_json,f,indent=4)
         f.close()
@@ -0,0 +1,56 @@
+import torch
+
+# 有限和の目的関数 (1/n) sum_i f_i(x) の oracle を行の部分集合 (minibatch) で評価するための行の選び方
+# sampler :
+#   "uniform" : minibatch ごとに独立に一様に選ぶ (復元抽出)
+#   "stratified" : クラスラベルの割合を保ち, 各クラスの中では一様に選ぶ
+#   "epoch" : epoch の始めに並べかえて batch_size 行ずつ順に使う (epoch の中では非復元抽出)
+# どの sampler でも ceil(data_num/batch_size) 個の minibatch を 1 epoch とする
+
+class MinibatchSampler:
+    def __init__(self,data_num,batch_size,sampler = "uniform",labels = None,device = "cpu"):
+        if sampler not in ("uniform","stratified","epoch"):
+            raise ValueError("No sampler.")
+        self.data_num = data_num
+        self.batch_size = min(int(batch_size),data_num)
+        self.sampler = sampler
+        self.device = device
+        self.batches_per_epoch = -(-data_num//self.batch_size)
+        self.count = 0
+        self.perm = None
+        if sampler == "stratified":
+            if labels is None:
+                raise ValueError("stratified sampler needs class labels.")
+            _,inverse,counts = torch.unique(labels,return_inverse = True,return_counts = True)
+            order = torch.argsort(inverse).to(device)
+            self.class_index = torch.split(order,counts.tolist())
+            self.class_prob = counts.to(torch.float64)/data_num
+
+    def __call__(self):
+        # 次の minibatch の行番号
+        position = self.count%self.batches_per_epoch
+        self.count += 1
+        if self.sampler == "uniform":
+            return torch.randint(self.data_num,(self.batch_size,),device = self.device)
+        if self.sampler == "stratified":
+            return self.__stratified__()
+        if position == 0:
+            self.perm = torch.randperm(self.data_num,device = self.device)
+        return self.perm[position*self.batch_size:(position + 1)*self.batch_size]
+
+    def __stratified__(self):
+        # クラス c に floor(batch_size*p_c) 行, 残りの行は p_c に比例して割り当てる
+        counts = torch.floor(self.batch_size*self.class_prob).to(torch.int64)
+        rest = self.batch_size - int(counts.sum())
+        if rest > 0:
+            counts += torch.bincount(torch.multinomial(self.class_prob,rest,replacement = True),minlength = counts.shape[0])
+        index = [c[torch.randint(c.shape[0],(int(k),),device = self.device)] for c,k in zip(self.class_index,counts) if k > 0]
+        return torch.cat(index)
+
+    def epoch_end(self):
+        # 直前の minibatch で epoch が終わったか
+        return self.count%self.batches_per_epoch == 0
+
+    def epoch(self):
+        # 終わった epoch の数
+        return self.count//self.batches_per_epoch
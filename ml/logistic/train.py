@@ -4,22 +4,21 @@ import torch.nn as nn
 import torch.optim as optim
 from torch.utils.data import TensorDataset,DataLoader,Dataset
 import numpy as np
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),"..",".."))
 
 def convert_coo_torch(X):
     values = X.data
-    indices = np.vstack((X.row,X.col))
-    i = torch.LongTensor(indices)
-    v = torch.FloatTensor(values)
+    indices = np.vstack((X.row,X.col)).astype(np.int64)
+    i = torch.from_numpy(indices)
+    v = torch.from_numpy(values).to(torch.float32)
     shape = X.shape
-    return torch.sparse.FloatTensor(i,v,torch.Size(shape))
+    return torch.sparse_coo_tensor(i,v,size = shape)
 
 
 def get_dataset(path_dataset = "./data/logistic/scotus_lexglue_tfidf_train.svm.bz2"):
-    from sklearn.datasets import load_svmlight_file
-    X,y = load_svmlight_file(path_dataset)
-    X = X.tocoo()
-    X = convert_coo_torch(X)
-    y = torch.from_numpy(y)
+    from utils import load_svmlight_cached
+    X,y = load_svmlight_cached(path_dataset,dtype = torch.float32,layout = "coo")
     y = y.to(torch.int64)
     class_num = torch.max(y)+1
     return TensorDataset(X.to(device),y.to(device)),class_num
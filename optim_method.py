@@ -2,7 +2,9 @@ import torch
 import matplotlib.pyplot as plt
 import numpy as np
 import os
-from utils import GetMinimumEig,compute_hvp,generate_sub_orthogonal
+from random_matrix import matmul,sample_directions
+from minibatch import MinibatchSampler
+from utils import GetMinimumEig,compute_hvp,Householder,hvp_closure,lanczos_min_eig,truncated_cg,reduced_hessian
 import time
 import json
 from environments import *
@@ -22,8 +24,22 @@ class __optim__:
         self.func = None
         self.device = None
         self.dtype = None
+        # sketch_dtype : 混合精度のとき P を持つ dtype (None なら dtype). 差分商は dtype で計算する
+        self.sketch_dtype = None
         self.start_time = None
         self.loss_time = 0
+        # trials : まとめて進める試行の数 (>1 なら xk は [trials,dim])
+        self.trials = 1
+        self.generators = None
+        # minibatch_size : None でなければ反復ごとに行を選び直し, その反復の oracle は全て同じ行で評価する
+        # minibatch_sampler : minibatch.MinibatchSampler を参照
+        self.minibatch_size = None
+        self.minibatch_sampler = "uniform"
+        self.minibatch = None
+        # snapshot_interval : None でなければ分散減少 (SVRG 型). この間隔 ("epoch" なら 1 epoch) ごとに __snapshot__ を呼ぶ
+        self.snapshot_interval = None
+        # direction_sampling : 差分をとる方向の選び方 (random_matrix.sample_directions を参照)
+        self.direction_sampling = "gaussian"
         return
 
     def __direction__(self,loss):
@@ -39,15 +55,18 @@ class __optim__:
         return
     
     def __log__(self,iteration):
-        min_val = torch.min(self.save_values[("fvalues","min")][:iteration])
-        time_val = self.save_values[("time_values","max")][iteration]
+        min_val = torch.min(self.save_values[("fvalues","min")][...,:iteration])
+        time_val = torch.max(self.save_values[("time_values","max")][...,iteration])
         logger.info(f"{iteration + 1}")
         logger.info(f"min_value:{min_val}")
         logger.info(f"time:{time_val}")
+        if ("inner_iterations","max") in self.save_values:
+            logger.info(f"inner_iterations:{self.func.inner_iteration()}")
     
     
     def __iter_per__(self,i):
         self.__clear__()
+        self.__set_iteration__(i)
         torch.cuda.synchronize()
         loss_start_time = time.time()
         loss = self.func(self.xk)
@@ -62,6 +81,67 @@ class __optim__:
     
     def __step__(self,i):
         return 1.0
+
+    def __set_iteration__(self,i):
+        self.func.set_iteration(i)
+        if self.snapshot_interval is not None and i%self.snapshot_interval == 0:
+            # snapshot は全データで計算する
+            self.func.clear_minibatch()
+            with torch.no_grad():
+                self.__snapshot__()
+        if self.minibatch is not None:
+            self.func.set_minibatch(self.minibatch())
+        return
+
+    def __snapshot__(self):
+        return
+
+    def __init_minibatch__(self,iterations):
+        # epoch の終わりごとに全データでの関数値を epoch_fvalues (その時刻を epoch_time_values) に記録する
+        self.func.clear_minibatch()
+        if self.minibatch_size is None:
+            # 全データの差分では分散減少の効果はなく, 評価が増えるだけ
+            if self.snapshot_interval is not None:
+                raise ValueError("snapshot_interval needs minibatch_size.")
+            return
+        data_num = self.func.data_num()
+        if data_num is None:
+            raise ValueError("minibatch needs a finite-sum objective.")
+        self.minibatch = MinibatchSampler(data_num,self.minibatch_size,self.minibatch_sampler,labels = self.func.labels(),device = self.device)
+        if self.snapshot_interval == "epoch":
+            self.snapshot_interval = self.minibatch.batches_per_epoch
+        epochs = iterations//self.minibatch.batches_per_epoch
+        if epochs == 0:
+            return
+        size = (epochs,) if self.trials == 1 else (self.trials,epochs)
+        self.save_values[("epoch_fvalues","min")] = torch.zeros(size,dtype = DTYPE)
+        self.save_values[("epoch_time_values","max")] = torch.zeros(size,dtype = DTYPE)
+
+    def __full_loss__(self):
+        self.func.clear_minibatch()
+        with torch.no_grad():
+            if self.trials > 1:
+                return self.func.batch_call(self.xk)
+            if getattr(self,"directional",False):
+                self.func.set_base_point(self.xk)
+                return self.func.base_call()
+            return self.func(self.xk)
+
+    def __log_epoch__(self):
+        if self.minibatch is None or not self.minibatch.epoch_end() or ("epoch_fvalues","min") not in self.save_values:
+            return
+        torch.cuda.synchronize()
+        loss_start_time = time.time()
+        loss = self.__full_loss__()
+        torch.cuda.synchronize()
+        self.loss_time += time.time() - loss_start_time
+        index = self.minibatch.epoch() - 1
+        if index >= self.save_values[("epoch_fvalues","min")].shape[-1]:
+            return
+        self.save_values[("epoch_fvalues","min")][...,index] = loss
+        self.save_values[("epoch_time_values","max")][...,index] = time.time() - self.loss_time - self.start_time
+        logger.info(f"epoch {index + 1} full loss:{torch.min(loss)}")
+        return
     
     def __iter__(self,func,x0,params,iterations,savepath,suffix = "",interval = None):
         if interval is None:
@@ -69,29 +149,63 @@ class __optim__:
         torch.cuda.synchronize()
         self.start_time = time.time()
         self.params = params
-        self.xk = x0
+        self.xk = x0 if self.trials == 1 else self.__init_trials__(x0)
         self.func = func
         self.__save_init__(iterations,fvalues = "min",time_values = "max")
+        self.__init_minibatch__(iterations)
         for i in range(iterations):
             self.__iter_per__(i)
+            self.__log_epoch__()
             if (i+1)%interval == 0:
                 self.__save__(savepath,suffix=suffix,fvalues = "min",time_values = "max")
                 self.__log__(i)
+        # func は次の試行や config でも使うので全データに戻しておく
+        self.func.clear_minibatch()
     
+    def __init_trials__(self,x0):
+        # 試行ごとに独立な乱数の列 (Generator) を用意し, x0 を trials 個並べる
+        seeds = torch.randint(0,2**62,(self.trials,))
+        self.generators = [torch.Generator(device = self.device).manual_seed(seed.item()) for seed in seeds]
+        return x0.detach().unsqueeze(0).repeat(self.trials,1)
+
+    def __sample_directions__(self,sample_size,dim,dtype = None):
+        return sample_directions(sample_size,dim,self.direction_sampling,device = self.device,dtype = self.dtype if dtype is None else dtype)
+
+    def __sketch_dtype__(self):
+        return self.dtype if self.sketch_dtype is None else self.sketch_dtype
+
+    def __trial_randn__(self,*size):
+        # [trials,*size] の正規乱数 (試行 k は k 番目の Generator から生成)
+        return torch.stack([torch.randn(*size,generator = g,device = self.device,dtype = self.dtype) for g in self.generators])
+
     def __save_init__(self,iterations,**kwargs):
+        size = (iterations,) if self.trials == 1 else (self.trials,iterations)
         for key,ope in kwargs.items():
-            self.save_values[(key,ope)] = torch.zeros(iterations,dtype = DTYPE)
+            self.save_values[(key,ope)] = torch.zeros(size,dtype = DTYPE)
+        # 入れ子の目的関数では内側の反復回数の累計 (warm start と eps のスケジュールの効果を見る) も記録する
+        # trials > 1 では試行をまとめて解くので全試行の合計
+        if self.func.inner_iteration() is not None:
+            self.save_values[("inner_iterations","max")] = torch.zeros(size,dtype = DTYPE)
             
     def __save_value__(self,index, **kwargs):
         for key,t in kwargs.items():
             ope = t[0]
             value = t[1]
-            self.save_values[(key,ope)][index] = value
+            self.save_values[(key,ope)][...,index] = value
+        if ("inner_iterations","max") in self.save_values:
+            self.save_values[("inner_iterations","max")][...,index] = self.func.inner_iteration()
             
     
     def __save__(self,savepath,suffix = "",**kwargs):
+        # trials > 1 なら suffix は試行ごとの list
+        if ("inner_iterations","max") in self.save_values:
+            kwargs = dict(kwargs,inner_iterations = "max")
         for key,ope in kwargs.items():
-            torch.save(self.save_values[(key,ope)],os.path.join(savepath,key + f"{suffix}.pth"))
+            if isinstance(suffix,list):
+                for k,s in enumerate(suffix):
+                    torch.save(self.save_values[(key,ope)][k],os.path.join(savepath,key + f"{s}.pth"))
+            else:
+                torch.save(self.save_values[(key,ope)],os.path.join(savepath,key + f"{suffix}.pth"))
         return
         
 
@@ -196,19 +310,47 @@ zeroth order method
 
 class random_gradient_free(__optim__):
     #　directionの計算を同時にやることで削減する方法もありそうだがとりあえずfor 文
-    def __init__(self,determine_stepsize = None,central = False):
+    def __init__(self,determine_stepsize = None,central = False,batch = False,directional = False,refresh_interval = 100,trials = 1,
+                 minibatch_size = None,minibatch_sampler = "uniform",snapshot_interval = None,direction_sampling = "gaussian"):
         # params = [mu,sample_size,lr]
         self.determine_stepsize  = determine_stepsize
         self.central = central
+        # batch : 全てのサンプル点での関数値をbatch_callでまとめて計算する
+        self.batch = batch
+        # directional : f(xk + mu*P[i]) を directional_batch_call で評価する (X@xk を使い回す)
+        # refresh_interval : 反復ごとに更新している X@xk を再計算する間隔
+        self.directional = directional
+        self.refresh_interval = refresh_interval
+        self.step_coef = None
         super().__init__()
+        # trials : 試行をまとめて xk : [trials,dim] で進める (全試行の摂動点を 1回の batch_call で評価)
+        self.trials = trials
+        self.minibatch_size = minibatch_size
+        self.minibatch_sampler = minibatch_sampler
+        # snapshot_interval : 分散減少. snapshot の x~ で P を固定し, 全データでの差分商 c~ を計算しておく.
+        # 各反復は同じ minibatch, 同じ P の差分商で c_B(x_k) - c_B(x~) + c~ を使う (評価は batch_call)
+        self.snapshot_interval = snapshot_interval
+        self.direction_sampling = direction_sampling
+        if self.trials > 1 and self.directional:
+            raise ValueError("trials > 1 does not support directional.")
+        if self.trials > 1 and self.direction_sampling != "gaussian":
+            raise ValueError("trials > 1 supports only gaussian directions.")
+        if self.snapshot_interval is not None and (self.trials > 1 or self.directional):
+            raise ValueError("snapshot_interval does not support trials > 1 and directional.")
         print("central",self.central)
 
     def __direction__(self,loss):
+        if self.snapshot_interval is not None:
+            return self.__vr_direction__(loss)
+        if self.directional:
+            return self.__directional_direction__(loss)
+        if self.batch:
+            return self.__batch_direction__(loss)
         mu = self.params[0]
         sample_size = self.params[1]
         dim = self.xk.shape[0]
         dir = None
-        P = torch.randn(sample_size,dim,device = self.device,dtype = self.dtype)/(sample_size**(0.5))
+        P = self.__sample_directions__(sample_size,dim)
         for i in range(sample_size):
             if self.central:
                 f1 = self.func(self.xk + mu*P[i])
@@ -224,6 +366,54 @@ class random_gradient_free(__optim__):
                 else:
                     dir += (f1.item() - loss.item())/mu * P[i]
         return - dir 
+
+    def __batch_direction__(self,loss):
+        sample_size = self.params[1]
+        dim = self.xk.shape[0]
+        P = self.__sample_directions__(sample_size,dim)
+        return - self.__coef__(self.xk,P,loss)@P
+
+    def __coef__(self,x,P,loss = None):
+        # P の各行方向の差分商 : [sample_size]. 前進差分で loss がなければ f(x) も同じ batch_call で評価する
+        mu = self.params[0]
+        sample_size = P.shape[0]
+        if self.central:
+            values = self.func.batch_call(torch.cat((x + mu*P,x - mu*P)))
+            return (values[:sample_size] - values[sample_size:])/(2*mu)
+        if loss is None:
+            values = self.func.batch_call(torch.cat((x.unsqueeze(0),x + mu*P)))
+            return (values[1:] - values[0])/mu
+        values = self.func.batch_call(x + mu*P)
+        return (values - loss)/mu
+
+    def __snapshot__(self):
+        sample_size = self.params[1]
+        dim = self.xk.shape[0]
+        self.snapshot_x = self.xk.detach().clone()
+        self.snapshot_P = self.__sample_directions__(sample_size,dim)
+        self.snapshot_coef = self.__coef__(self.snapshot_x,self.snapshot_P)
+        return
+
+    def __vr_direction__(self,loss):
+        P = self.snapshot_P
+        coef = self.__coef__(self.xk,P,loss) - self.__coef__(self.snapshot_x,P) + self.snapshot_coef
+        return - coef@P
+
+    def __directional_direction__(self,loss):
+        mu = self.params[0]
+        sample_size = self.params[1]
+        dim = self.xk.shape[0]
+        P = self.__sample_directions__(sample_size,dim,dtype = self.__sketch_dtype__())
+        self.func.set_directions(P.transpose(0,1))
+        I = torch.eye(sample_size,device = self.device,dtype = self.dtype)
+        if self.central:
+            values = self.func.directional_batch_call(mu*torch.cat((I,-I),dim = 1))
+            coef = (values[:sample_size] - values[sample_size:])/(2*mu)
+        else:
+            values = self.func.directional_batch_call(mu*I)
+            coef = (values - loss)/mu
+        self.step_coef = - coef
+        return - matmul(P.transpose(0,1),coef)
     
     def __step__(self,i):
         if self.determine_stepsize is not None:
@@ -232,8 +422,55 @@ class random_gradient_free(__optim__):
             lr = self.params[2]
             return lr
     
+    def __trials_iter_per__(self,i):
+        mu = self.params[0]
+        sample_size = self.params[1]
+        self.__set_iteration__(i)
+        torch.cuda.synchronize()
+        loss_start_time = time.time()
+        loss = self.func.batch_call(self.xk)
+        torch.cuda.synchronize()
+        self.loss_time += time.time() - loss_start_time
+        trials,dim = self.xk.shape
+        P = self.__trial_randn__(sample_size,dim)/(sample_size**(0.5))
+        xk = self.xk.unsqueeze(1)
+        if self.central:
+            xs = torch.cat((xk + mu*P,xk - mu*P),dim = 1)
+        else:
+            xs = xk + mu*P
+        values = self.func.batch_call(xs.reshape(-1,dim)).reshape(trials,-1)
+        if self.central:
+            coef = (values[:,:sample_size] - values[:,sample_size:])/(2*mu)
+        else:
+            coef = (values - loss.unsqueeze(1))/mu
+        dk = - torch.einsum("ks,ksd->kd",coef,P)
+        lr = self.__step__(i)
+        self.__update__(lr*dk)
+        torch.cuda.synchronize()
+        self.__save_value__(i,fvalues = ("min",loss),time_values = ("max",time.time() - self.loss_time - self.start_time))
+        return
+
     def __iter_per__(self, i):
-        return super().__iter_per__(i)
+        if self.trials > 1:
+            return self.__trials_iter_per__(i)
+        if not self.directional:
+            return super().__iter_per__(i)
+        self.__clear__()
+        self.__set_iteration__(i)
+        torch.cuda.synchronize()
+        loss_start_time = time.time()
+        self.func.set_base_point(self.xk,refresh = i%self.refresh_interval == 0)
+        loss = self.func.base_call()
+        torch.cuda.synchronize()
+        self.loss_time += time.time() - loss_start_time
+        dk = self.__direction__(loss)
+        lr = self.__step__(i)
+        self.__update__(lr*dk)
+        # xk の移動 lr*dk = P^T@(lr*step_coef) に合わせて X@xk も更新する
+        self.func.move_base_point(lr*self.step_coef)
+        torch.cuda.synchronize()
+        self.__save_value__(i,fvalues = ("min",loss.item()),time_values = ("max",time.time() - self.loss_time - self.start_time))
+        return
 
     def __save_init__(self, iterations, **kwargs):
         self.xk.requires_grad_(False)
@@ -251,7 +488,8 @@ class orthogonal_zeroth_order(__optim__):
             sample_size = self.params[1]
             dim = self.xk.shape[0]
             dir = None
-            P = generate_sub_orthogonal(sample_size,dim)
+            # H = I - 2vv^T の最初の sample_size 行 (行列は作らない)
+            P = Householder.random(sample_size,dim,device = self.device,dtype = self.dtype)
             for i in range(sample_size):
                 f1 = self.func(self.xk + mu*P[i])
                 f2 = self.func(self.xk - mu*P[i])
@@ -280,10 +518,23 @@ second order method
 """
     
 class NewtonMethod(__optim__):
-    def __init__(self):
+    def __init__(self,matrix_free = False,cg_iteration = 100,cg_tol = 1e-6):
+        # matrix_free : H を作らず, HVP による CG で H d = -g を解く
+        self.matrix_free = matrix_free
+        self.cg_iteration = cg_iteration
+        self.cg_tol = cg_tol
+        self.loss = None
         super().__init__()
     
     def __direction__(self,loss):
+        self.loss = loss
+        if self.matrix_free:
+            g,hvp_ = hvp_closure(loss,self.xk)
+            self.xk.grad = g
+            d,_ = truncated_cg(hvp_,g,tol = self.cg_tol,iteration = self.cg_iteration)
+            if g@d > 0:
+                d = -d
+            return d
         H = hessian(self.func,self.xk)
         loss.backward()
         return - torch.linalg.solve(H,self.xk.grad)
@@ -300,6 +551,7 @@ class NewtonMethod(__optim__):
 class SubspaceNewton(__optim__):
     def __init__(self):
         self.Pk = None
+        self.loss = None
         super().__init__()
     
     def subspace_func(self,d):
@@ -308,12 +560,12 @@ class SubspaceNewton(__optim__):
     def __direction__(self,loss):
         reduced_dim = self.params[0]
         dim = self.xk.shape[0]
-        self.Pk = torch.randn(dim,reduced_dim)/(dim**0.5)
-        self.Pk = self.Pk.to(self.device)
-        d = torch.zeros(reduced_dim).to(self.device)
-        PHP = hessian(self.subspace_func,d)
-        loss.backward()
-        return - self.Pk @ torch.linalg.solve(PHP,self.Pk.transpose(0,1)@self.xk.grad)
+        self.loss = loss
+        self.Pk = torch.randn(dim,reduced_dim,device = self.device,dtype = self.xk.dtype)/(dim**0.5)
+        # P^T H P と勾配を同じ計算で求める
+        g,PHP = reduced_hessian(self.func,self.xk,self.Pk,loss = loss)
+        self.xk.grad = g
+        return - self.Pk @ torch.linalg.solve(PHP,self.Pk.transpose(0,1)@g)
     
     def __update__(self, dk):
         alpha = self.params[1]
@@ -326,6 +578,8 @@ class SubspaceNewton(__optim__):
 
 class SubspaceRNM(__optim__):
     def __init__(self):
+        self.Pk = None
+        self.loss = None
         super().__init__()
     
     def subspace_func(self,d):
@@ -337,16 +591,15 @@ class SubspaceRNM(__optim__):
         c2 = self.params[2]
         r = self.params[3]
         dim = self.xk.shape[0]
+        self.loss = loss
 
-        self.Pk = torch.randn(dim,reduced_dim)/(dim**0.5)
-        self.Pk = self.Pk.to(self.device)
-        d = torch.zeros(reduced_dim).to(self.device)
-        PHP = hessian(self.subspace_func,d)
-        loss.backward()
+        self.Pk = torch.randn(dim,reduced_dim,device = self.device,dtype = self.xk.dtype)/(dim**0.5)
+        g,PHP = reduced_hessian(self.func,self.xk,self.Pk,loss = loss)
+        self.xk.grad = g
         min_eig = GetMinimumEig(PHP)
         Lambda_k = max(0,-min_eig)
-        Mk = PHP + c1*Lambda_k*torch.eye(reduced_dim,device = self.device) + c2 * torch.linalg.norm(self.xk.grad)**r * torch.eye(reduced_dim,device= self.device)
-        return - self.Pk@ torch.linalg.solve(Mk, self.Pk.transpose(0,1)@self.xk.grad)
+        Mk = PHP + c1*Lambda_k*torch.eye(reduced_dim,device = self.device,dtype = PHP.dtype) + c2 * torch.linalg.norm(g)**r * torch.eye(reduced_dim,device= self.device,dtype = PHP.dtype)
+        return - self.Pk@ torch.linalg.solve(Mk, self.Pk.transpose(0,1)@g)
     
     def __update__(self, dk):
         alpha = self.params[4]
@@ -358,7 +611,13 @@ class SubspaceRNM(__optim__):
         return super().__update__(lr*dk)
 
 class ExtendedRMM(__optim__):
-    def __init__(self):
+    def __init__(self,matrix_free = False,cg_iteration = 100,cg_tol = 1e-6,lanczos_iteration = 20):
+        # matrix_free : 最小固有値は Lanczos 法で推定し, M_k d = -g は HVP による CG で解く
+        self.matrix_free = matrix_free
+        self.cg_iteration = cg_iteration
+        self.cg_tol = cg_tol
+        self.lanczos_iteration = lanczos_iteration
+        self.loss = None
         super().__init__()
     
     def __direction__(self,loss):
@@ -366,6 +625,19 @@ class ExtendedRMM(__optim__):
         c2 = self.params[1]
         r = self.params[2]
         dim = self.xk.shape[0]
+        self.loss = loss
+        if self.matrix_free:
+            g,hvp_ = hvp_closure(loss,self.xk)
+            self.xk.grad = g
+            min_eig = lanczos_min_eig(hvp_,torch.randn_like(g),iteration = self.lanczos_iteration)
+            Lambda_k = max(0,-min_eig)
+            shift = c1*Lambda_k + c2 * torch.linalg.norm(g)**r
+            def hvp_shift(v):
+                return hvp_(v) + shift*v
+            d,_ = truncated_cg(hvp_shift,g,tol = self.cg_tol,iteration = self.cg_iteration)
+            if g@d > 0:
+                d = -d
+            return d
         H = hessian(self.func,self.xk)
         loss.backward()
         min_eig = GetMinimumEig(H)
@@ -385,72 +657,35 @@ class ExtendedRMM(__optim__):
     
 
 
-# class NewtonCG(__optim__):
-#     def __init__(self):
-#         super().__init__()
+class NewtonCG(__optim__):
+    # 打ち切り CG による Newton-CG (Hessian は HVP でのみ使う)
+    def __init__(self):
+        # params = [eps,cg_tol,cg_iteration,alpha,beta]
+        self.loss = None
+        super().__init__()
     
-#     def update_parameters(self,M,e,l):
-#         k = (M + 2*e)/e
-#         le = l/3/k
-#         t = k**0.5/(k**0.5 + 1)
-#         T = 4*k**4 / (1 - t**0.5)**2
-#         return k,le,t,T
-
+    def __direction__(self,loss):
+        eps = self.params[0]
+        cg_tol = self.params[1]
+        cg_iteration = self.params[2]
+        self.loss = loss
+        g,hvp_ = hvp_closure(loss,self.xk)
+        self.xk.grad = g
+        d,kind = truncated_cg(hvp_,g,eps = eps,tol = cg_tol,iteration = cg_iteration)
+        if kind == "NC":
+            # 負の曲率方向は降下方向に向きをそろえ, 曲率の大きさでスケールする
+            d_norm = torch.linalg.norm(d)
+            curvature = torch.abs(d@hvp_(d))/d_norm**2
+            d = curvature*d/d_norm
+            if g@d > 0:
+                d = -d
+        return d
     
-#     def CCG(self,g,e,l,M = 0):
-#         k = (M + 2*e)/e
-#         le = l/3/k
-#         t = k**0.5/(k**0.5 + 1)
-#         T = 4*k**4 / (1 - t**0.5)**2
-
-#         y = torch.zeros(g.shape[0],device = self.device)
-#         ys = [y]
-#         Hys = [y]
-#         r = g
-#         p = -g
-#         Hp = compute_hvp(self.func,self.xk,p)
-#         if p@Hp < - e*p@p:
-#             return p,"NC"
-        
-#         if torch.linalg.norm(Hp) > M*torch.linalg.norm(p):
-#             M = torch.linalg.norm(Hp)/torch.linalg.norm(p)
-#             k,le,t,T = self.update_parameters(M,e,l)
-#         j = 0
-#         while True:
-#             alpha = (r@r)/(p@Hp + 2*e * p@p)
-#             y1 = y + alpha*p
-#             r1 = r + alpha*Hp
-#             beta = (r1@r1)/(r@r)
-#             p1 = -r1 + beta*p
-#             j += 1
-#             Hp1 = compute_hvp(self.func,self.xk,p1)
-#             if torch.linalg.norm(Hp1) > M*torch.linalg.norm(p1):
-#                 M = torch.linalg.norm(Hp1)/torch.linalg.norm(p1)
-#                 k,le,t,T = self.update_parameters(M,e,l)
-#             Hy1 = compute_hvp(self.func,self.xk,y1)
-#             if torch.linalg.norm(Hy1) > M*torch.linalg.norm(y1):
-#                 M = torch.linalg.norm(Hy1)/torch.linalg.norm(y1)
-#                 k,le,t,T = self.update_parameters(M,e,l)
-#             Hr1 = compute_hvp(self.func,self.xk,r1)
-#             if torch.linalg.norm(Hr1) > M*torch.linalg.norm(r1):
-#                 M = torch.linalg.norm(Hr1)/torch.linalg.norm(r1)
-#                 k,le,t,T = self.update_parameters(M,e,l)
-            
-#             ys.append(y1)
-#             Hys.append(Hy1)
-            
-#             if y1@Hr1 < -e*y1@y1:
-#                 return y1,"NC"
-#             if torch.linalg.norm(r1) < le*torch.linalg.norm(g):
-#                 return y1,"SOL"
-#             if p1@Hp1 < -e*p1@p1:
-#                 return p1,"NC"
-#             if torch.linalg.norm(r1) > T**0.5 * t**(j/2) * torch.linalg.norm(g):
-#                 alpha =r1@r1/(p1@Hp1 + 2*e * p1@p1 )
-#                 y2 = y1 + alpha*p1
-
-#             r = r1
-#             p = p1
-#             y = y1
-
-#     def Lanczes
+    def __update__(self, dk):
+        alpha = self.params[3]
+        beta = self.params[4]
+        lr = 1
+        with torch.no_grad():
+            while self.loss.item() - self.func(self.xk + lr*dk) < -alpha*lr*self.xk.grad@dk:
+                lr *= beta  
+        return super().__update__(lr*dk)
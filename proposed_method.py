@@ -1,5 +1,6 @@
 from optim_method import __optim__
 from utils import generate_sparse_random
+from random_matrix import SketchSampler,transpose_matmul,gram,matmul
 from environments import DEVICE,DTYPE
 import torch
 import time
@@ -7,30 +8,85 @@ import time
 
 
 class proposed(__optim__):
-    def __init__(self,determine_stepsize,central = False,projection = False):
+    def __init__(self,determine_stepsize,central = False,projection = False,batch = False,directional = False,refresh_interval = 100,implicit = False,chunk_size = 65536,sketch = "gaussian",sparsity = 1,kron_dim = None,trials = 1,
+                 minibatch_size = None,minibatch_sampler = "uniform",snapshot_interval = None,direction_sampling = "gaussian"):
         #params = [reduced_dim,sample_size,mu,lr]
         self.determine_stepsize  = determine_stepsize
         self.central = central
         super().__init__()
         self.projection = projection
+        self.batch = batch
+        self.directional = directional
+        self.refresh_interval = refresh_interval
+        self.step_coef = None
+        # sketch : P の種類 ("gaussian","srht","sparse-sign","kronecker")
+        # implicit : (gaussian) P を保持せず seed から chunk_size 行ずつ生成する
+        # kronecker : func.layout() の行列ブロックごとに P1 U P2^T (P1 の列数 reduced_dim, P2 の列数 kron_dim) で動かす
+        self.sketch = sketch
+        self.implicit = implicit
+        self.chunk_size = chunk_size
+        self.sparsity = sparsity
+        self.kron_dim = kron_dim
+        self.sketch_sampler = None
+        self.subspace_dim = None
+        # trials : 試行をまとめて xk : [trials,dim] で進める (P は試行ごとの密なガウス行列)
+        self.trials = trials
+        self.minibatch_size = minibatch_size
+        self.minibatch_sampler = minibatch_sampler
+        # snapshot_interval : 分散減少. snapshot の x~ で P を固定し, 全データで P の各列方向の差分商 g~ (~ P^T grad f(x~)) を計算しておく.
+        # 各反復は U を取り直し, 同じ minibatch での差分商で c_B(x_k) - c_B(x~) + U@g~ を使う (評価は batch_call)
+        self.snapshot_interval = snapshot_interval
+        # direction_sampling : U の選び方 (random_matrix.sample_directions を参照)
+        self.direction_sampling = direction_sampling
+        if self.trials > 1 and self.direction_sampling != "gaussian":
+            raise ValueError("trials > 1 supports only gaussian U.")
+        if self.snapshot_interval is not None and (self.trials > 1 or self.projection or self.directional):
+            raise ValueError("snapshot_interval does not support trials > 1, projection and directional.")
+        # snapshot では P の全ての列方向の点 (reduced_dim 個の dim 次元の点) を作るので, P を持たない sketch では使わない
+        if self.snapshot_interval is not None and (self.implicit or self.sketch != "gaussian"):
+            raise ValueError("snapshot_interval supports only dense gaussian P.")
+        if self.trials > 1 and (self.projection or self.directional or self.implicit or self.sketch != "gaussian"):
+            raise ValueError("trials > 1 supports only dense gaussian P without projection and directional.")
         print("central",self.central)
+
+    def __subspace__(self,dim,reduced_dim):
+        if self.sketch_sampler is None:
+            self.sketch_sampler = SketchSampler(sketch = self.sketch,implicit = self.implicit,chunk_size = self.chunk_size,sparsity = self.sparsity,
+                                                kron_dim = self.kron_dim,device = self.device,dtype = self.__sketch_dtype__())
+        P = self.sketch_sampler(dim,reduced_dim,layout = self.func.layout())
+        # kronecker では部分空間の次元は P の列数 (因子の大きさの和) で, reduced_dim とは限らない
+        self.subspace_dim = P.shape[1]
+        return P
     
     def __direction__(self,loss):
+        if self.snapshot_interval is not None:
+            return self.__vr_direction__(loss)
+        if self.directional:
+            return self.__directional_direction__(loss)
+        if self.batch:
+            return self.__batch_direction__(loss)
         reduced_dim = self.params[0]
         sample_size = self.params[1]
         mu = self.params[2]
         dim = self.xk.shape[0]
-        P = torch.randn(dim,reduced_dim,device = self.device,dtype = self.dtype)/torch.sqrt(torch.tensor(dim,device = self.device,dtype = self.dtype))
+        P = self.__subspace__(dim,reduced_dim)
+        reduced_dim = P.shape[1]
         subspace_dir = None
         if self.projection:
-            U = torch.randn(sample_size,reduced_dim+1,device = self.device,dtype = self.dtype)/torch.sqrt(torch.tensor(sample_size,device = self.device,dtype = self.dtype))
-            U[:,0]=1
+            U = torch.cat((torch.ones(sample_size,1,device = self.device,dtype = self.dtype),self.__sample_directions__(sample_size,reduced_dim)),dim = 1)
         else:
-            U = torch.randn(sample_size,reduced_dim,device = self.device,dtype = self.dtype)/torch.sqrt(torch.tensor(sample_size,device = self.device,dtype = self.dtype))
+            U = self.__sample_directions__(sample_size,reduced_dim)
+        V = U[:,1:] if self.projection else U
+        if self.implicit:
+            # implicit な P は P@v のたびに全ての chunk を生成しなおすので, 摂動はまとめて一度に作る
+            M = mu*(P@V.transpose(0,1)).transpose(0,1)
+            perturbation = lambda i: M[i]
+        else:
+            perturbation = lambda i: mu*(P@V[i])
         if self.central:
             if self.projection:
                 for i in range(sample_size):
-                    m = mu*P@U[i,1:]
+                    m = perturbation(i)
                     U[i,0] = torch.linalg.norm(self.xk + m)
                     g1 = self.func(self.xk + m,u= mu*U[i])
                     U[i,0] = torch.linalg.norm(self.xk - m)
@@ -41,7 +97,7 @@ class proposed(__optim__):
                         subspace_dir += (g1 - g2)/(2*mu) * U[i,1:]
             else:
                 for i in range(sample_size):
-                    m = mu*P@U[i]
+                    m = perturbation(i)
                     g1 = self.func(self.xk + m)
                     g2 = self.func(self.xk - m)
                     if subspace_dir is None:
@@ -50,6 +106,7 @@ class proposed(__optim__):
                         subspace_dir += (g1 - g2)/(2*mu) * U[i]
         else:
             for i in range(sample_size):
+                m = perturbation(i)
                 g1 = self.func(self.xk + m)
                 if subspace_dir is None:
                     subspace_dir = (g1 - loss.item())/mu * U[i]
@@ -57,11 +114,141 @@ class proposed(__optim__):
                     subspace_dir += (g1 - loss.item())/mu * U[i]
         return - P@subspace_dir
 
+    def __batch_direction__(self,loss):
+        reduced_dim = self.params[0]
+        sample_size = self.params[1]
+        mu = self.params[2]
+        dim = self.xk.shape[0]
+        P = self.__subspace__(dim,reduced_dim)
+        reduced_dim = P.shape[1]
+        if self.projection:
+            U = torch.cat((torch.ones(sample_size,1,device = self.device,dtype = self.dtype),self.__sample_directions__(sample_size,reduced_dim)),dim = 1)
+            V = U[:,1:]
+        else:
+            U = self.__sample_directions__(sample_size,reduced_dim)
+            V = U
+        # 全サンプルの摂動 mu*P@U[i] : [sample_size,dim]
+        M = mu*(P@V.transpose(0,1)).transpose(0,1)
+        if self.central:
+            xs = torch.cat((self.xk + M,self.xk - M))
+        else:
+            xs = self.xk + M
+        if self.projection:
+            us = mu*U.repeat(xs.shape[0]//sample_size,1)
+            if not self.central:
+                # loss は射影しない内側の問題の値なので, 基準点 xk も同じ射影した u (方向は 0) で評価する
+                xs = torch.cat((self.xk.unsqueeze(0),xs))
+                us = torch.cat((torch.zeros_like(us[:1]),us))
+            us[:,0] = mu*torch.linalg.norm(xs,dim = 1)
+            values = self.func.batch_call(xs,us = us)
+            if not self.central:
+                loss = values[0]
+                values = values[1:]
+        else:
+            values = self.func.batch_call(xs)
+        if self.central:
+            coef = (values[:sample_size] - values[sample_size:])/(2*mu)
+        else:
+            coef = (values - loss)/mu
+        return - P@(coef@V)
+
+    def __coef__(self,x,P,V,loss = None):
+        # 方向 P@V[i] の差分商 : [V.shape[0]]. 前進差分で loss がなければ f(x) も同じ batch_call で評価する
+        mu = self.params[2]
+        n = V.shape[0]
+        M = mu*(P@V.transpose(0,1)).transpose(0,1)
+        if self.central:
+            values = self.func.batch_call(torch.cat((x + M,x - M)))
+            return (values[:n] - values[n:])/(2*mu)
+        if loss is None:
+            values = self.func.batch_call(torch.cat((x.unsqueeze(0),x + M)))
+            return (values[1:] - values[0])/mu
+        values = self.func.batch_call(x + M)
+        return (values - loss)/mu
+
+    def __snapshot__(self):
+        reduced_dim = self.params[0]
+        dim = self.xk.shape[0]
+        self.snapshot_x = self.xk.detach().clone()
+        self.snapshot_P = self.__subspace__(dim,reduced_dim)
+        I = torch.eye(self.snapshot_P.shape[1],device = self.device,dtype = self.dtype)
+        self.snapshot_grad = self.__coef__(self.snapshot_x,self.snapshot_P,I)
+        return
+
+    def __vr_direction__(self,loss):
+        sample_size = self.params[1]
+        P = self.snapshot_P
+        U = self.__sample_directions__(sample_size,P.shape[1])
+        coef = self.__coef__(self.xk,P,U,loss) - self.__coef__(self.snapshot_x,P,U) + U@self.snapshot_grad
+        return - P@(coef@U)
+
+    def __directional_direction__(self,loss):
+        reduced_dim = self.params[0]
+        sample_size = self.params[1]
+        mu = self.params[2]
+        dim = self.xk.shape[0]
+        P = self.__subspace__(dim,reduced_dim)
+        reduced_dim = P.shape[1]
+        if self.projection:
+            U = torch.cat((torch.ones(sample_size,1,device = self.device,dtype = self.dtype),self.__sample_directions__(sample_size,reduced_dim)),dim = 1)
+            V = U[:,1:]
+        else:
+            U = self.__sample_directions__(sample_size,reduced_dim)
+            V = U
+        self.func.set_directions(P)
+        C = mu*V.transpose(0,1)
+        if self.central:
+            C = torch.cat((C,-C),dim = 1)
+        if self.projection:
+            us = mu*U.repeat(C.shape[1]//sample_size,1)
+            if not self.central:
+                # 基準点も射影した u (方向は 0) で評価する (__batch_direction__ と同じ)
+                C = torch.cat((torch.zeros_like(C[:,:1]),C),dim = 1)
+                us = torch.cat((torch.zeros_like(us[:1]),us))
+            # \|xk + P@c\|^2 = \|xk\|^2 + 2 (P^T xk)@c + c^T (P^T P) c
+            Px = transpose_matmul(P,self.xk)
+            PP = gram(P).to(self.dtype)
+            norms = self.xk@self.xk + 2*Px@C + torch.sum(C*(PP@C),dim = 0)
+            us[:,0] = mu*torch.sqrt(torch.clamp(norms,min = 0))
+            values = self.func.directional_batch_call(C,us = us)
+            if not self.central:
+                loss = values[0]
+                values = values[1:]
+        else:
+            values = self.func.directional_batch_call(C)
+        if self.central:
+            coef = (values[:sample_size] - values[sample_size:])/(2*mu)
+        else:
+            coef = (values - loss)/mu
+        self.step_coef = - coef@V
+        return matmul(P,self.step_coef)
+
+    def __trials_direction__(self,loss):
+        reduced_dim = self.params[0]
+        sample_size = self.params[1]
+        mu = self.params[2]
+        trials,dim = self.xk.shape
+        P = self.__trial_randn__(dim,reduced_dim)/dim**0.5
+        U = self.__trial_randn__(sample_size,reduced_dim)/sample_size**0.5
+        # 試行 k の摂動 mu*P_k@U_k[i] : [trials,sample_size,dim]
+        M = mu*torch.einsum("kdr,ksr->ksd",P,U)
+        xk = self.xk.unsqueeze(1)
+        if self.central:
+            xs = torch.cat((xk + M,xk - M),dim = 1)
+        else:
+            xs = xk + M
+        values = self.func.batch_call(xs.reshape(-1,dim)).reshape(trials,-1)
+        if self.central:
+            coef = (values[:,:sample_size] - values[:,sample_size:])/(2*mu)
+        else:
+            coef = (values - loss.unsqueeze(1))/mu
+        return - torch.einsum("kdr,kr->kd",P,torch.einsum("ks,ksr->kr",coef,U))
+
     def __step__(self,i):
         if type(self.determine_stepsize) is str:
             lr = self.params[3]
-            dim = self.xk.shape[0]
-            reduced_dim = self.params[0]
+            dim = self.xk.shape[-1]
+            reduced_dim = self.params[0] if self.subspace_dim is None else self.subspace_dim
             return lr*((dim)**2)/(reduced_dim**2)
         elif self.determine_stepsize is not None:
             return self.determine_stepsize(i);
@@ -78,29 +265,47 @@ class proposed(__optim__):
         torch.cuda.synchronize()
         self.start_time = time.time()
         self.params = params
-        self.xk = x0
+        self.xk = x0 if self.trials == 1 else self.__init_trials__(x0)
         self.xk.requires_grad_(False)
         self.func = func
         if self.projection:
             self.func.projection = self.projection
         self.__save_init__(iterations,fvalues = "min",time_values = "max",norm_dir = "iter")
+        self.__init_minibatch__(iterations)
         for i in range(iterations):
             self.__iter_per__(i)
+            self.__log_epoch__()
             if (i+1)%interval == 0:
                 self.__save__(savepath=savepath,suffix=suffix,fvalues = "min",time_values = "max")
                 self.__log__(i)
+        self.func.clear_minibatch()
     
     def __iter_per__(self,i):
         self.__clear__()
+        self.__set_iteration__(i)
         torch.cuda.synchronize()
         loss_start_time = time.time()
-        loss = self.func(self.xk)
+        if self.directional:
+            self.func.set_base_point(self.xk,refresh = i%self.refresh_interval == 0)
+            loss = self.func.base_call()
+        elif self.trials > 1:
+            loss = self.func.batch_call(self.xk)
+        else:
+            loss = self.func(self.xk)
         torch.cuda.synchronize()
         self.loss_time += time.time() - loss_start_time
-        dk = self.__direction__(loss)
+        dk = self.__trials_direction__(loss) if self.trials > 1 else self.__direction__(loss)
         lr = self.__step__(i)
         self.__update__(lr*dk)
+        if self.directional:
+            # xk の移動 lr*dk = P@(lr*step_coef) に合わせて X@xk も X@P から更新する
+            self.func.move_base_point(lr*self.step_coef)
         torch.cuda.synchronize()
+        if self.trials > 1:
+            self.__save_value__(i,fvalues = ("min",loss),
+                    time_values = ("max",time.time() - self.loss_time - self.start_time),
+                    norm_dir = ("iter",torch.linalg.vector_norm(dk,dim = 1)))
+            return
         self.__save_value__(i,fvalues = ("min",loss.item()),
                 time_values = ("max",time.time() - self.loss_time - self.start_time),
                 norm_dir = ("iter",torch.linalg.norm(dk).item()))
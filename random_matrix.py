@@ -0,0 +1,458 @@
+import torch
+
+# seed と chunk の番号から生成器を初期化するための定数 (splitmix64)
+GOLDEN_GAMMA = 0x9E3779B97F4A7C15
+
+_column_sorted_cache = {}
+# minibatch では X が反復ごとに変わるので最近のものだけ残す
+COLUMN_SORTED_CACHE_SIZE = 4
+
+def is_sparse_matrix(X):
+    return X.layout in (torch.sparse_coo,torch.sparse_csr,torch.sparse_csc)
+
+def sparse_triplets(X):
+    # 疎行列 X (COO, CSR, CSC) の非零要素 (row,col,value)
+    if X.layout == torch.sparse_coo:
+        X = X.coalesce()
+        row,col = X.indices()
+        return row,col,X.values()
+    if X.layout == torch.sparse_csr:
+        crow = X.crow_indices()
+        col = X.col_indices()
+        row = torch.repeat_interleave(torch.arange(X.shape[0],device = col.device),crow[1:] - crow[:-1])
+        return row,col,X.values()
+    ccol = X.ccol_indices()
+    row = X.row_indices()
+    col = torch.repeat_interleave(torch.arange(X.shape[1],device = row.device),ccol[1:] - ccol[:-1])
+    return row,col,X.values()
+
+def column_sorted(X):
+    # 疎行列 X の非零要素を列番号でソートしたもの (row,col,value) を返す (CSC ならソートは不要)
+    cached = _column_sorted_cache.get(id(X))
+    if cached is not None and cached[0] is X:
+        return cached[1]
+    row,col,values = sparse_triplets(X)
+    if X.layout != torch.sparse_csc:
+        order = torch.argsort(col)
+        row,col,values = row[order],col[order],values[order]
+    triplets = (row,col,values)
+    _column_sorted_cache[id(X)] = (X,triplets)
+    if len(_column_sorted_cache) > COLUMN_SORTED_CACHE_SIZE:
+        del _column_sorted_cache[next(iter(_column_sorted_cache))]
+    return triplets
+
+class ChunkedMatrix:
+    # dim x reduced_dim の行列を chunk_size 行ずつ __block__ で生成しながら積を計算する
+    def __init__(self,dim,reduced_dim,chunk_size = 65536,device = "cpu",dtype = torch.float64):
+        self.shape = (dim,reduced_dim)
+        self.chunk_size = chunk_size
+        self.device = device
+        self.dtype = dtype
+
+    def __block__(self,index):
+        # index 番目の chunk (start,end,P[start:end]) を返す
+        return
+
+    def blocks(self,start = 0,end = None):
+        # [start,end) の行を含む chunk を順に生成する
+        if end is None:
+            end = self.shape[0]
+        for index in range(start//self.chunk_size,(end - 1)//self.chunk_size + 1):
+            yield self.__block__(index)
+
+    def rows(self,start,end):
+        out = torch.empty(end - start,self.shape[1],device = self.device,dtype = self.dtype)
+        for s,e,block in self.blocks(start,end):
+            s_ = max(s,start)
+            e_ = min(e,end)
+            out[s_ - start:e_ - start] = block[s_ - s:e_ - s]
+        return out
+
+    def __matmul__(self,v):
+        # P@v, v : [reduced_dim] or [reduced_dim,k]
+        out = torch.empty((self.shape[0],) + v.shape[1:],device = self.device,dtype = self.dtype)
+        for start,end,block in self.blocks():
+            out[start:end] = block@v
+        return out
+
+    def t_matmul(self,y):
+        # P^T@y, y : [dim] or [dim,k]
+        out = None
+        for start,end,block in self.blocks():
+            out_ = block.transpose(0,1)@y[start:end]
+            out = out_ if out is None else out + out_
+        return out
+
+    def gram(self):
+        # P^T@P
+        out = None
+        for start,end,block in self.blocks():
+            out_ = block.transpose(0,1)@block
+            out = out_ if out is None else out + out_
+        return out
+
+    def left_matmul(self,X,group = 1):
+        # X@P[:m*group].reshape(m,group*reduced_dim), X : [data_num,m]
+        # group > 1 のとき P の行 j*group + t は X の列 j に対応する
+        data_num,m = X.shape
+        reduced_dim = self.shape[1]
+        out = torch.zeros(data_num,group*reduced_dim,device = self.device,dtype = self.dtype)
+        sparse = is_sparse_matrix(X)
+        if sparse:
+            row,col,values = column_sorted(X)
+        for start,end,block in self.blocks(0,m*group):
+            end = min(end,m*group)
+            block = block[:end - start]
+            feature_start = start//group
+            feature_end = (end - 1)//group + 1
+            # chunk の境界が group の途中にある場合は 0 で埋めて列ごとにそろえる
+            padded = torch.zeros((feature_end - feature_start)*group,reduced_dim,device = self.device,dtype = self.dtype)
+            padded[start - feature_start*group:end - feature_start*group] = block
+            padded = padded.reshape(feature_end - feature_start,group*reduced_dim)
+            if sparse:
+                lo = torch.searchsorted(col,feature_start)
+                hi = torch.searchsorted(col,feature_end)
+                out.index_add_(0,row[lo:hi],values[lo:hi].unsqueeze(1)*padded[col[lo:hi] - feature_start])
+            else:
+                out += X[:,feature_start:feature_end]@padded
+        return out
+
+class ImplicitGaussianMatrix(ChunkedMatrix):
+    # dim x reduced_dim のガウス行列. 全体を保持せず, 必要なときに chunk ごとに seed から生成する
+    def __init__(self,dim,reduced_dim,seed,chunk_size = 65536,scale = None,device = "cpu",dtype = torch.float64):
+        super().__init__(dim,reduced_dim,chunk_size = chunk_size,device = device,dtype = dtype)
+        self.seed = seed
+        if scale is None:
+            scale = 1/dim**0.5
+        self.scale = scale
+
+    def __block__(self,index):
+        dim,reduced_dim = self.shape
+        start = index*self.chunk_size
+        end = min(start + self.chunk_size,dim)
+        generator = torch.Generator(device = self.device)
+        generator.manual_seed((self.seed*GOLDEN_GAMMA + index) % 2**63)
+        block = torch.randn(end - start,reduced_dim,generator = generator,device = self.device,dtype = self.dtype)
+        return start,end,self.scale*block
+
+def fwht(x):
+    # 正規化した Walsh-Hadamard 変換 H@x, x : [N,k] (N は 2 のべき)
+    N = x.shape[0]
+    k = x.shape[1]
+    h = 1
+    while h < N:
+        x = x.reshape(N//(2*h),2,h,k)
+        x = torch.stack((x[:,0] + x[:,1],x[:,0] - x[:,1]),dim = 1)
+        h *= 2
+    return x.reshape(N,k)/N**0.5
+
+class SRHTMatrix(ChunkedMatrix):
+    # P = sqrt(N/dim) * D H[:dim,S] (D : 符号, H : N x N の Hadamard 行列, S : reduced_dim 本の列)
+    # P@v, P^T@y は O(N log N) の高速 Hadamard 変換で計算し, X@P のみ chunk ごとに生成する
+    def __init__(self,dim,reduced_dim,chunk_size = 65536,device = "cpu",dtype = torch.float64):
+        super().__init__(dim,reduced_dim,chunk_size = chunk_size,device = device,dtype = dtype)
+        self.bits = max(1,(dim - 1).bit_length())
+        self.N = 2**self.bits
+        self.signs = (2*torch.randint(0,2,(dim,),device = device) - 1).to(dtype)
+        # 列は重複なしで選ぶ (重複すると P@v で v の要素が失われ, rows や t_matmul と一致しない)
+        self.columns = torch.randperm(self.N,device = device)[:reduced_dim]
+        self.scale = (self.N/dim)**0.5
+
+    def __block__(self,index):
+        dim,reduced_dim = self.shape
+        start = index*self.chunk_size
+        end = min(start + self.chunk_size,dim)
+        # H[i,j] = (-1)^{popcount(i&j)}/sqrt(N)
+        i_and_j = torch.arange(start,end,device = self.device).unsqueeze(1) & self.columns.unsqueeze(0)
+        parity = torch.zeros_like(i_and_j)
+        for b in range(self.bits):
+            parity ^= (i_and_j >> b) & 1
+        block = (1 - 2*parity).to(self.dtype)*(self.signs[start:end].unsqueeze(1)*self.scale/self.N**0.5)
+        return start,end,block
+
+    def __matmul__(self,v):
+        dim,reduced_dim = self.shape
+        z = torch.zeros((self.N,) + v.shape[1:],device = self.device,dtype = self.dtype)
+        z[self.columns] = v
+        z = fwht(z.reshape(self.N,-1))[:dim]
+        out = self.scale*self.signs.unsqueeze(1)*z
+        return out.reshape((dim,) + v.shape[1:])
+
+    def t_matmul(self,y):
+        dim,reduced_dim = self.shape
+        z = torch.zeros((self.N,) + y.shape[1:],device = self.device,dtype = self.dtype)
+        z[:dim] = self.signs.reshape((dim,) + (1,)*(y.dim() - 1))*y
+        z = fwht(z.reshape(self.N,-1))[self.columns]
+        out = self.scale*z
+        return out.reshape((reduced_dim,) + y.shape[1:])
+
+class SparseSignMatrix:
+    # 各行に sparsity 個の非零要素 ±sqrt(reduced_dim/(sparsity*dim)) を持つ CSR 行列 (sparsity = 1 で CountSketch)
+    # crow_indices と行番号は buffers に保存して反復間で使い回す
+    def __init__(self,dim,reduced_dim,sparsity = 1,buffers = None,device = "cpu",dtype = torch.float64):
+        self.shape = (dim,reduced_dim)
+        self.sparsity = sparsity
+        self.device = device
+        self.dtype = dtype
+        if buffers is None:
+            buffers = {}
+        key = ("sparse-sign",dim,sparsity)
+        if key not in buffers:
+            buffers[key] = (torch.arange(0,dim*sparsity + 1,sparsity,device = device),
+                            torch.arange(dim,device = device).repeat_interleave(sparsity))
+        self.crow_indices,self.row_indices = buffers[key]
+        self.col_indices = torch.randint(0,reduced_dim,(dim*sparsity,),device = device)
+        self.values = (2*torch.randint(0,2,(dim*sparsity,),device = device) - 1).to(dtype)*(reduced_dim/(sparsity*dim))**0.5
+        self.P = torch.sparse_csr_tensor(self.crow_indices,self.col_indices,self.values,size = self.shape,device = device,dtype = dtype)
+
+    def rows(self,start,end):
+        out = torch.zeros(end - start,self.shape[1],device = self.device,dtype = self.dtype)
+        lo = start*self.sparsity
+        hi = end*self.sparsity
+        out.index_put_((self.row_indices[lo:hi] - start,self.col_indices[lo:hi]),self.values[lo:hi],accumulate = True)
+        return out
+
+    def __matmul__(self,v):
+        return self.P@v
+
+    def t_matmul(self,y):
+        out = torch.zeros((self.shape[1],) + y.shape[1:],device = self.device,dtype = self.dtype)
+        values = self.values.reshape((-1,) + (1,)*(y.dim() - 1))
+        out.index_add_(0,self.col_indices,values*y[self.row_indices])
+        return out
+
+    def gram(self):
+        reduced_dim = self.shape[1]
+        cols = self.col_indices.reshape(-1,self.sparsity)
+        values = self.values.reshape(-1,self.sparsity)
+        out = torch.zeros(reduced_dim,reduced_dim,device = self.device,dtype = self.dtype)
+        for a in range(self.sparsity):
+            for b in range(self.sparsity):
+                out.index_put_((cols[:,a],cols[:,b]),values[:,a]*values[:,b],accumulate = True)
+        return out
+
+    def left_matmul(self,X,group = 1):
+        # P の行 j*group + t は X の列 j, 出力の列 t*reduced_dim + (P の列) に対応する
+        data_num,m = X.shape
+        reduced_dim = self.shape[1]
+        cols = self.col_indices.reshape(-1,self.sparsity)
+        values = self.values.reshape(-1,self.sparsity)
+        out = torch.zeros(data_num,group*reduced_dim,device = self.device,dtype = self.dtype)
+        if is_sparse_matrix(X):
+            row,col,X_values = sparse_triplets(X)
+            for t in range(group):
+                p = col*group + t
+                out.index_put_((row.unsqueeze(1).expand(-1,self.sparsity),t*reduced_dim + cols[p]),
+                               X_values.unsqueeze(1)*values[p],accumulate = True)
+        else:
+            features = torch.arange(m,device = self.device).repeat_interleave(self.sparsity)
+            for t in range(group):
+                p = torch.arange(m,device = self.device)*group + t
+                # P_t^T : [reduced_dim,m] を COO で作り (P_t^T@X^T)^T を計算する
+                P_t = torch.sparse_coo_tensor(torch.stack((cols[p].flatten(),features)),values[p].flatten(),size = (reduced_dim,m))
+                out[:,t*reduced_dim:(t+1)*reduced_dim] = torch.sparse.mm(P_t,X.transpose(0,1)).transpose(0,1)
+        return out
+
+class SketchSampler:
+    # 部分空間行列 P (dim x reduced_dim) を毎反復生成する
+    # sketch : "gaussian", "srht", "sparse-sign", "kronecker"
+    def __init__(self,sketch = "gaussian",implicit = False,chunk_size = 65536,sparsity = 1,kron_dim = None,device = "cpu",dtype = torch.float64):
+        self.sketch = sketch
+        self.implicit = implicit
+        self.chunk_size = chunk_size
+        self.sparsity = sparsity
+        self.kron_dim = kron_dim
+        self.device = device
+        self.dtype = dtype
+        self.buffers = {}
+
+    def __call__(self,dim,reduced_dim,layout = None):
+        if self.sketch == "kronecker":
+            # 行列の形のブロックがない x では kronecker にならないので, gaussian で代用せずに止める
+            if layout is None:
+                raise ValueError("kronecker sketch needs a function with matrix-shaped blocks (layout).")
+            return KroneckerMatrix(layout,reduced_dim,kron_dim = self.kron_dim,device = self.device,dtype = self.dtype)
+        if self.sketch == "gaussian":
+            if self.implicit:
+                seed = torch.randint(0,2**62,(1,)).item()
+                return ImplicitGaussianMatrix(dim,reduced_dim,seed,chunk_size = self.chunk_size,device = self.device,dtype = self.dtype)
+            return torch.randn(dim,reduced_dim,device = self.device,dtype = self.dtype)/dim**0.5
+        elif self.sketch == "srht":
+            return SRHTMatrix(dim,reduced_dim,chunk_size = self.chunk_size,device = self.device,dtype = self.dtype)
+        elif self.sketch == "sparse-sign":
+            return SparseSignMatrix(dim,reduced_dim,sparsity = self.sparsity,buffers = self.buffers,device = self.device,dtype = self.dtype)
+        else:
+            raise ValueError("No sketch.")
+
+class KroneckerImage:
+    # X@P (softmax などの [data_num,group,k]) を (X@P1, P2) の形で保持する
+    def __init__(self,XP1,P2,offset):
+        self.XP1 = XP1
+        self.P2 = P2
+        self.offset = offset
+
+    def __matmul__(self,C):
+        # C : [k,batch_size] -> [data_num,group,batch_size]
+        r1 = self.XP1.shape[1]
+        r2 = self.P2.shape[1]
+        U = C[self.offset:self.offset + r1*r2].reshape(r1,r2,-1)
+        # (X@P1) U P2^T
+        T = torch.einsum("ijb,tj->itb",U,self.P2)
+        Z = self.XP1@T.reshape(r1,-1)
+        return Z.reshape(self.XP1.shape[0],self.P2.shape[0],-1)
+
+    def to(self,dtype):
+        return KroneckerImage(self.XP1.to(dtype),self.P2.to(dtype),self.offset)
+
+class KroneckerMatrix:
+    # x を layout のブロック (行列) に分け, 行列 (a,b) のブロックは P1 U P2^T (P1 : a x r1, P2 : b x r2) で動かす
+    # 1 次元のブロックはガウス行列. 列の数は各ブロックの r1*r2 (または r) の和
+    def __init__(self,layout,reduced_dim,kron_dim = None,device = "cpu",dtype = torch.float64):
+        if kron_dim is None:
+            kron_dim = reduced_dim
+        self.factors = []
+        self.offsets = []
+        dim = 0
+        columns = 0
+        for shape in layout:
+            if len(shape) == 2:
+                a,b = shape
+                r1 = min(a,reduced_dim)
+                r2 = min(b,kron_dim)
+                P1 = torch.randn(a,r1,device = device,dtype = dtype)/a**0.5
+                P2 = torch.randn(b,r2,device = device,dtype = dtype)/b**0.5
+                self.factors.append((P1,P2))
+                size = a*b
+                columns_ = r1*r2
+            else:
+                a = shape[0]
+                r = min(a,reduced_dim)
+                self.factors.append((torch.randn(a,r,device = device,dtype = dtype)/a**0.5,))
+                size = a
+                columns_ = r
+            self.offsets.append((dim,columns))
+            dim += size
+            columns += columns_
+        self.shape = (dim,columns)
+        self.device = device
+        self.dtype = dtype
+
+    def __matmul__(self,v):
+        V = v.reshape(self.shape[1],-1)
+        k = V.shape[1]
+        out = []
+        for factor,(_,column) in zip(self.factors,self.offsets):
+            if len(factor) == 2:
+                P1,P2 = factor
+                r1 = P1.shape[1]
+                r2 = P2.shape[1]
+                U = V[column:column + r1*r2].reshape(r1,r2,k)
+                out.append(torch.einsum("ai,ijk,bj->abk",P1,U,P2).reshape(-1,k))
+            else:
+                P = factor[0]
+                out.append(P@V[column:column + P.shape[1]])
+        return torch.cat(out).reshape((self.shape[0],) + v.shape[1:])
+
+    def t_matmul(self,y):
+        Y = y.reshape(self.shape[0],-1)
+        k = Y.shape[1]
+        out = []
+        for factor,(start,_) in zip(self.factors,self.offsets):
+            if len(factor) == 2:
+                P1,P2 = factor
+                a = P1.shape[0]
+                b = P2.shape[0]
+                W = Y[start:start + a*b].reshape(a,b,k)
+                out.append(torch.einsum("ai,abk,bj->ijk",P1,W,P2).reshape(-1,k))
+            else:
+                P = factor[0]
+                out.append(P.transpose(0,1)@Y[start:start + P.shape[0]])
+        return torch.cat(out).reshape((self.shape[1],) + y.shape[1:])
+
+    def gram(self):
+        blocks = []
+        for factor in self.factors:
+            if len(factor) == 2:
+                P1,P2 = factor
+                blocks.append(torch.kron(P1.transpose(0,1)@P1,P2.transpose(0,1)@P2))
+            else:
+                P = factor[0]
+                blocks.append(P.transpose(0,1)@P)
+        return torch.block_diag(*blocks)
+
+    def rows(self,start,end):
+        return (self@torch.eye(self.shape[1],device = self.device,dtype = self.dtype))[start:end]
+
+    def left_matmul(self,X,group = 1):
+        data_num,m = X.shape
+        factor = self.factors[0]
+        if group > 1 and len(factor) == 2 and factor[0].shape[0] == m and factor[1].shape[0] == group:
+            # 最初のブロックが W : [m,group] のとき X@W = (X@P1) U P2^T. 大きな積は X@P1 だけ
+            P1,P2 = factor
+            return KroneckerImage(X@P1,P2,self.offsets[0][1])
+        # それ以外は P を作ってから計算する
+        D = self@torch.eye(self.shape[1],device = self.device,dtype = self.dtype)
+        return X@D[:m*group].reshape(m,group*self.shape[1])
+
+def sample_directions(sample_size,dim,sampling = "gaussian",device = "cpu",dtype = torch.float64):
+    # 方向 [sample_size,dim]. 各行は N(0,I/sample_size) と同じ分布 (E[sum_i p_i p_i^T] = I)
+    # orthogonal : dim 行ずつのブロックの中で直交 (QR, 行の長さはガウスベクトルと同じ chi 分布)
+    # antithetic : p と -p の組 (前進差分でも偶数次の誤差が打ち消し合う)
+    # sobol : scrambled Sobol 点を逆誤差関数でガウスに変換した準モンテカルロ (dim <= SobolEngine.MAXDIM)
+    if sampling == "gaussian":
+        return torch.randn(sample_size,dim,device = device,dtype = dtype)/sample_size**0.5
+    elif sampling == "orthogonal":
+        blocks = []
+        for start in range(0,sample_size,dim):
+            k = min(dim,sample_size - start)
+            Q,R = torch.linalg.qr(torch.randn(dim,k,device = device,dtype = dtype))
+            # sign(diag R) をかけると Q の列は Haar 分布の直交行列の列
+            Q = Q*torch.sign(torch.diagonal(R))
+            norms = torch.sqrt(torch.distributions.Chi2(torch.tensor(float(dim),device = device,dtype = dtype)).sample((k,)))
+            blocks.append(Q.transpose(0,1)*norms.unsqueeze(1))
+        return torch.cat(blocks)/sample_size**0.5
+    elif sampling == "antithetic":
+        half = torch.randn(-(-sample_size//2),dim,device = device,dtype = dtype)
+        return torch.cat((half,-half))[:sample_size]/sample_size**0.5
+    elif sampling == "sobol":
+        if dim > torch.quasirandom.SobolEngine.MAXDIM:
+            raise ValueError(f"sobol directions need dim <= {torch.quasirandom.SobolEngine.MAXDIM}.")
+        engine = torch.quasirandom.SobolEngine(dim,scramble = True,seed = int(torch.randint(0,2**31 - 1,(1,))))
+        u = engine.draw(sample_size,dtype = dtype).to(device)
+        eps = torch.finfo(dtype).eps
+        u = torch.clamp(u,eps,1 - eps)
+        return 2**0.5*torch.erfinv(2*u - 1)/sample_size**0.5
+    else:
+        raise ValueError("No direction sampling.")
+
+def rows(D,start,end):
+    if isinstance(D,torch.Tensor):
+        return D[start:end]
+    return D.rows(start,end)
+
+def matmul(D,C):
+    # D@C を C の dtype で返す (D が低い精度 (混合精度の P) なら C を D の dtype にして掛ける)
+    return (D@C.to(D.dtype)).to(C.dtype)
+
+def transpose_matmul(D,y):
+    y_ = y.to(D.dtype)
+    if isinstance(D,torch.Tensor):
+        return (D.transpose(0,1)@y_).to(y.dtype)
+    return D.t_matmul(y_).to(y.dtype)
+
+def gram(D):
+    if isinstance(D,torch.Tensor):
+        return D.transpose(0,1)@D
+    return D.gram()
+
+def left_matmul(X,D,group = 1):
+    # X@D[:m*group].reshape(m,group*k) を group = 1 なら [data_num,k], それ以外は [data_num,group,k] で返す
+    if isinstance(D,torch.Tensor):
+        m = X.shape[1]
+        k = D.shape[1]
+        out = X@D[:m*group].reshape(m,group*k)
+    else:
+        out = D.left_matmul(X,group)
+    if group == 1 or isinstance(out,KroneckerImage):
+        return out
+    return out.reshape(out.shape[0],group,-1)
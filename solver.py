@@ -7,21 +7,42 @@ def projection_ball2(x,t,r = 1):
         return x
     else:
         return r*x/torch.linalg.norm(x)
+
+def projection_ball2_batch(X,t,r = 1):
+    # Xの各行 x_j を \|x_j\|_2 \le r_j へ射影 (r はスカラーか [batch_size])
+    norm = torch.linalg.vector_norm(X,dim = 1)
+    scale = torch.clamp(r/torch.clamp(norm,min = torch.finfo(X.dtype).tiny),max = 1)
+    return X*scale.unsqueeze(1)
     
 
 class BackTrackingPGD:
-    def __init__(self,func,prox):
+    def __init__(self,func,prox,func_grad = None):
         self.func = func
         self.xk = None
         self.prox = prox
         self.iter = 0
         # prox(x,t)
+        # func_grad(x) -> (func(x),grad func(x)) が与えられれば autograd を使わない
+        self.func_grad = func_grad
+
+    def __value_and_grad__(self,x):
+        if self.func_grad is not None:
+            with torch.no_grad():
+                return self.func_grad(x)
+        x = x.detach().requires_grad_(True)
+        with torch.enable_grad():
+            f = self.func(x)
+            g, = torch.autograd.grad(f,x)
+        return f.detach(),g
     
-    def backtracking(self,g,beta,eps = 0):
+    def backtracking(self,g,beta,eps = 0,fx = None):
+        # fx : f(x_k) (計算済みなら再計算しない)
         max_iter = 10000
         t = 1
+        if fx is None:
+            fx = self.func(self.xk)
         x_ = self.prox(self.xk - t*g,t)
-        while t*self.func(x_) > t*self.func(self.xk) - t*g@(self.xk - x_) + 1/2*((self.xk - x_)@(self.xk - x_)) + eps:
+        while t*self.func(x_) > t*fx - t*g@(self.xk - x_) + 1/2*((self.xk - x_)@(self.xk - x_)) + eps:
             t *= beta
             max_iter -= 1
             x_ = self.prox(self.xk - t*g,t)
@@ -33,17 +54,13 @@ class BackTrackingPGD:
 
     def __one_iter__(self,eps,beta):
         self.iter +=1
-        self.xk.grad = None
-        f = self.func(self.xk)
-        f.backward()
-        g = self.xk.grad
+        f,g = self.__value_and_grad__(self.xk)
         with torch.no_grad():
-            t = self.backtracking(g,beta=beta)
+            t = self.backtracking(g,beta=beta,fx=f)
             x_ = self.prox(self.xk - t*g,t)
             if self.check_stop(x_ - self.xk,t*eps):
                 return True
             self.xk = x_.detach().clone()
-            self.xk.requires_grad = True        
         return False
 
     
@@ -53,7 +70,6 @@ class BackTrackingPGD:
     def __iter__(self,x0,iteration,eps=1e-6,beta = 0.8):
         self.iter = 0
         self.xk = x0.clone().detach()
-        self.xk.requires_grad = True
         for idx in range(iteration):
             stop_flag = self.__one_iter__(eps=eps,beta=beta)
             if stop_flag:
@@ -68,12 +84,9 @@ class BackTrackingPGD:
         return self.xk.clone().detach()
 
     def get_grad_norm(self,beta = 0.8):
-        self.xk.grad = None
-        f = self.func(self.xk)
-        f.backward()
-        g = self.xk.grad
+        f,g = self.__value_and_grad__(self.xk)
         with torch.no_grad():
-            t = self.backtracking(g,beta=beta)
+            t = self.backtracking(g,beta=beta,fx=f)
             G_t = (self.xk - self.prox(self.xk - t*g,t))/t
             return torch.linalg.norm(G_t)
         
@@ -82,18 +95,22 @@ class BackTrackingPGD:
         return self.iter
 
 class BackTrackingAccerelatedPGD(BackTrackingPGD):
-    def __init__(self, func, prox):
-        super().__init__(func, prox)
+    def __init__(self, func, prox,func_grad = None):
+        super().__init__(func, prox,func_grad = func_grad)
         self.t = 1
         self.v = None
         self.xk1 = None
         self.k = 0
+        # fk : f(x_k) (リスタートの判定に使う, backtracking で計算済みの値)
+        self.fk = None
+        self.f_ = None
 
     def __iter__(self,x0,iteration,eps=1e-6,beta = 0.8,restart = False):
         self.iter = 0
         self.k = 0
         self.xk = x0.clone().detach()
         self.xk1 = x0.clone().detach()
+        self.fk = None
         for idx in range(iteration):
             stop_flag = self.__one_iter__(eps=eps,beta=beta,restart=restart)
             if stop_flag:
@@ -101,12 +118,17 @@ class BackTrackingAccerelatedPGD(BackTrackingPGD):
         print("max iteration")
     
     
-    def backtracking(self, g, beta):
+    def backtracking(self, g, beta,fv = None):
+        # fv : f(v) (計算済みなら再計算しない), 受理した点での値は self.f_ に残す
+        if fv is None:
+            fv = self.func(self.v)
         _x = self.prox(self.v-self.t*g,self.t)
-
-        while self.t*self.func(_x) > self.t*self.func(self.v) + self.t*g@(_x - self.v) + 1/2*((_x - self.v)@(_x - self.v)):
+        f_ = self.func(_x)
+        while self.t*f_ > self.t*fv + self.t*g@(_x - self.v) + 1/2*((_x - self.v)@(_x - self.v)):
             self.t *= beta
-            _x = self.prox(self.v-self.t*g,self.t)    
+            _x = self.prox(self.v-self.t*g,self.t)
+            f_ = self.func(_x)
+        self.f_ = f_
         return self.t
 
     def __one_iter__(self,eps,beta,restart):
@@ -114,35 +136,191 @@ class BackTrackingAccerelatedPGD(BackTrackingPGD):
         self.k += 1
         k = self.k
         self.v = self.xk + (k-2)/(k+1)*(self.xk - self.xk1)
-        self.v.requires_grad = True
-        f = self.func(self.v)
-        f.backward()
-        g = self.v.grad
+        f,g = self.__value_and_grad__(self.v)
         with torch.no_grad():
-            t = self.backtracking(g,beta=beta)
+            t = self.backtracking(g,beta=beta,fv=f)
             x_ = self.prox(self.v - t*g,t)
             if self.check_stop(x_ - self.v,t*eps):
                 return True
+            if self.fk is None:
+                self.fk = self.func(self.xk)
             self.xk1 = self.xk
             self.xk = x_.detach().clone()
             self.v = None
+            fk1 = self.fk
+            self.fk = self.f_
             if restart:
-                if self.func(self.xk) > self.func(self.xk1):
+                if self.fk > fk1:
                     self.k = 0      
         return False
 
     def get_grad_norm(self,beta = 0.8):
-        self.xk.requires_grad = True
-        self.xk.grad = None
-        f = self.func(self.xk)
-        f.backward()
-        g = self.xk.grad
+        f,g = self.__value_and_grad__(self.xk)
         with torch.no_grad():
             self.v = self.xk
-            t = self.backtracking(g,beta=beta)
+            t = self.backtracking(g,beta=beta,fv=f)
             G_t = (self.xk - self.prox(self.xk - t*g,t))/t
             self.v = None
-        self.xk.requires_grad = False
         return torch.linalg.norm(G_t)
         
-    
\ No newline at end of file
+    
+class BatchedBackTrackingAccerelatedPGD:
+    # 球制約 \|x_j\|_2 \le r_j の問題 j = 1,...,batch_size を同時に解く加速 PGD
+    # func(X,index) : X [m,dim] (index番目の問題の点) -> [m] の関数値
+    # ステップ幅, リスタート, 収束判定は問題ごとに持ち, 収束していない問題だけを batch で進める
+    # func_grad(X,index) -> (関数値 [m],勾配 [m,dim]) が与えられれば autograd を使わない
+    def __init__(self,func,r = 1,func_grad = None):
+        self.func = func
+        self.func_grad = func_grad
+        self.r = r
+        self.fk = None
+        self.xk = None
+        self.xk1 = None
+        self.t = None
+        self.k = None
+        self.active = None
+        self.iter = 0
+
+    def __radius__(self,index):
+        if torch.is_tensor(self.r):
+            return self.r[index]
+        return self.r
+
+    def __value_and_grad__(self,V,index):
+        if self.func_grad is not None:
+            with torch.no_grad():
+                return self.func_grad(V,index)
+        V = V.detach().requires_grad_(True)
+        with torch.enable_grad():
+            f = self.func(V,index)
+            g, = torch.autograd.grad(f.sum(),V)
+        return f.detach(),g
+
+    def __iter__(self,x0,iteration,eps=1e-6,beta = 0.8,restart = False):
+        batch_size = x0.shape[0]
+        self.iter = 0
+        self.xk = x0.clone().detach()
+        self.xk1 = x0.clone().detach()
+        self.t = torch.ones(batch_size,device = x0.device,dtype = x0.dtype)
+        self.k = torch.zeros(batch_size,device = x0.device,dtype = torch.int64)
+        self.active = torch.ones(batch_size,device = x0.device,dtype = torch.bool)
+        self.fk = None
+        for idx in range(iteration):
+            index = torch.nonzero(self.active).squeeze(1)
+            if index.shape[0] == 0:
+                return
+            self.__one_iter__(index,eps=eps,beta=beta,restart=restart)
+        print("max iteration")
+
+    def backtracking(self,v,fv,g,index,beta):
+        t = self.t[index]
+        r = self.__radius__(index)
+        x_ = projection_ball2_batch(v - t.unsqueeze(1)*g,t,r = r)
+        # 条件を満たしていない問題だけ関数値を計算し直す
+        f_ = torch.empty_like(fv)
+        pending = torch.arange(index.shape[0],device = v.device)
+        while pending.shape[0] > 0:
+            d = x_[pending] - v[pending]
+            t_ = t[pending]
+            f_[pending] = self.func(x_[pending],index[pending])
+            lhs = t_*f_[pending]
+            rhs = t_*fv[pending] + t_*torch.sum(g[pending]*d,dim = 1) + 1/2*torch.sum(d*d,dim = 1)
+            pending = pending[lhs > rhs]
+            if pending.shape[0] == 0:
+                break
+            t[pending] *= beta
+            r_ = r[pending] if torch.is_tensor(r) else r
+            x_[pending] = projection_ball2_batch(v[pending] - t[pending].unsqueeze(1)*g[pending],t[pending],r = r_)
+        self.t[index] = t
+        # f_ : 受理した点での関数値
+        return t,x_,f_
+
+    def __one_iter__(self,index,eps,beta,restart):
+        self.iter += 1
+        self.k[index] += 1
+        k = self.k[index].unsqueeze(1).to(self.xk.dtype)
+        xk = self.xk[index]
+        v = xk + (k-2)/(k+1)*(xk - self.xk1[index])
+        fv,g = self.__value_and_grad__(v,index)
+        with torch.no_grad():
+            t,x_,f_ = self.backtracking(v,fv,g,index,beta=beta)
+            if restart and self.fk is None:
+                self.fk = self.func(self.xk,torch.arange(self.xk.shape[0],device = self.xk.device))
+            stop = torch.linalg.vector_norm(x_ - v,dim = 1) < t*eps
+            self.active[index[stop]] = False
+            move = ~stop
+            index = index[move]
+            if index.shape[0] == 0:
+                return
+            self.xk1[index] = xk[move]
+            self.xk[index] = x_[move]
+            if restart:
+                # f(x_{k+1}) は backtracking で, f(x_k) は前の反復で計算済み
+                f_ = f_[move]
+                reset = index[f_ > self.fk[index]]
+                self.fk[index] = f_
+                self.k[reset] = 0
+
+    def get_function_value(self):
+        with torch.no_grad():
+            return self.func(self.xk,torch.arange(self.xk.shape[0],device = self.xk.device))
+
+    def get_solution(self):
+        return self.xk.clone().detach()
+
+    def get_iteration(self):
+        return self.iter
+
+class InnerSolver:
+    # 入れ子の目的関数の内側の問題を BackTrackingAccerelatedPGD で解く.
+    # warm_start なら同じ形の直前の解から始める.
+    # 許容誤差は eps_k = max(eps,eps_init*eps_decay^k) (k : 外側の反復回数)
+    def __init__(self,eps = 1e-6,iteration = 10000,warm_start = False,eps_init = None,eps_decay = 0.9):
+        self.eps = eps
+        self.iteration = iteration
+        self.warm_start = warm_start
+        self.eps_init = eps_init
+        self.eps_decay = eps_decay
+        self.outer_iteration = 0
+        # 形ごとの直前の解
+        self.solutions = {}
+        self.batch_solution = None
+        self.total_iteration = 0
+
+    def set_iteration(self,i):
+        self.outer_iteration = i
+
+    def reset(self):
+        # 保存した解, warm start の解, 反復回数を消す (別の試行や config の前に呼ぶ)
+        self.outer_iteration = 0
+        self.solutions = {}
+        self.batch_solution = None
+        self.total_iteration = 0
+
+    def get_eps(self):
+        if self.eps_init is None:
+            return self.eps
+        return max(self.eps,self.eps_init*self.eps_decay**self.outer_iteration)
+
+    def solve(self,func,prox,x0,func_grad = None):
+        if self.warm_start and tuple(x0.shape) in self.solutions:
+            x0 = self.solutions[tuple(x0.shape)]
+        solver = BackTrackingAccerelatedPGD(func=func,prox=prox,func_grad=func_grad)
+        solver.__iter__(x0=x0,iteration=self.iteration,eps=self.get_eps(),restart=True)
+        value = solver.get_function_value()
+        solution = solver.get_solution()
+        self.total_iteration += solver.get_iteration()
+        self.solutions[tuple(solution.shape)] = solution.detach()
+        return value,solution
+
+    def solve_batch(self,func,x0,r,func_grad = None):
+        # 球制約の問題を BatchedBackTrackingAccerelatedPGD でまとめて解く (warm start は直前の batch の解から)
+        if self.warm_start and self.batch_solution is not None and self.batch_solution.shape == x0.shape:
+            x0 = self.batch_solution
+        solver = BatchedBackTrackingAccerelatedPGD(func=func,r=r,func_grad=func_grad)
+        solver.__iter__(x0=x0,iteration=self.iteration,eps=self.get_eps(),restart=True)
+        values = solver.get_function_value()
+        solution = solver.get_solution()
+        self.total_iteration += solver.get_iteration()
+        self.batch_solution = solution
+        return values,solution
@@ -77,6 +77,31 @@ def save_result_json(save_path,values_dict,iteration):
     with open(save_path,"w") as f2:
         json.dump(result_json,f2,indent=4)
 
+def remove_result_json(save_path,values_dict,iteration):
+    # save_result_json で追加した 1 試行分の値を取り除き, mean と std を計算しなおす
+    if not os.path.exists(save_path):
+        return
+    with open(save_path,"r") as f:
+        result_json = json.load(f)
+    for index in range(len(result_json["result"])):
+        element = result_json["result"][index]
+        if element["iteration"] == iteration and values_dict in element["save_values"]:
+            element["save_values"].remove(values_dict)
+            if len(element["save_values"]) == 0:
+                result_json["result"].pop(index)
+            else:
+                optim_values = [each_json["fvalues"] for each_json in element["save_values"]]
+                element["mean"] = np.mean(np.array(optim_values))
+                element["std"] = np.std(np.array(optim_values))
+            with open(save_path,"w") as f2:
+                json.dump(result_json,f2,indent=4)
+            return
+
+def append_json_line(path,entry):
+    # 1 行ずつ追記する (fork した試行からも書くので行ごとに O_APPEND で書く)
+    with open(path,"a") as f:
+        f.write(json.dumps(entry) + "\n")
+
 def count_files(init_dir,pattern):
     list_dir = os.listdir(init_dir)
     count = 0
@@ -86,6 +111,19 @@ def count_files(init_dir,pattern):
             count +=1
     return count
 
+def allocate_suffix(init_dir,prefix = "fvalues",ext = ".pth"):
+    # prefix + suffix + ext を O_CREAT|O_EXCL で作って suffix を確保する (並列に走る試行でも重複しない)
+    count = 0
+    while True:
+        suffix = "" if count == 0 else str(count)
+        try:
+            fd = os.open(os.path.join(init_dir,prefix + suffix + ext),os.O_CREAT|os.O_EXCL|os.O_WRONLY)
+        except FileExistsError:
+            count += 1
+            continue
+        os.close(fd)
+        return suffix
+
 def find_files(init_dir,pattern):
     list_dir = os.listdir(init_dir)
     output_files = []
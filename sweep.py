@@ -0,0 +1,194 @@
+import os
+import re
+import sys
+import json
+import copy
+import random
+import hashlib
+import itertools
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor,as_completed
+import numpy as np
+import torch
+from environments import *
+from main import run_many,get_savepath
+from summarizing.modify_json import find_files,remove_result_json
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+logger.addHandler(logging.StreamHandler(sys.stdout))
+
+# sweep の設定ファイル (json)
+# {
+#   "name" : "lr-sweep",
+#   "base" : config.json と同じ形 (なければ make_config.py の設定),
+#   "grid" : {"params.lr" : [1e-1,1e-2], "properties.delta" : [1e-3,1e-2]},
+#   "random" : {"samples" : 10, "seed" : 0, "params.mu" : {"log-uniform" : [1e-10,1e-6]}},
+#   "workers" : 4,
+#   "threads" : 1
+# }
+# キーは "params.lr" のように "." で区切った config の中の位置 ("solver" などトップレベルもよい).
+# grid の全ての組合せに random の samples 個の点をそれぞれ掛け合わせる.
+# config の中身のハッシュごとに開始の印 (.started) と完了の印 (.done) を残すので, 中断しても同じ sweep をもう一度実行すれば続きから走る.
+# 開始したが完了していない config は, その config が書いた試行 (<hash>.trials に記録した suffix のファイルと result.json の値) だけを消してからやり直す.
+# 結果の場所は iterations などが違う config や手で実行した結果と共有するので, 場所ごとは消さない.
+# 失敗した config はログに残して残りの config を続ける (.done を残さないので次の実行でやり直す).
+
+SWEEPPATH = "sweep"
+# 結果に影響しないので hash に含めないキー
+EXECUTION_KEYS = ["workers","threads","trial_log"]
+
+def set_value(config,key,value):
+    keys = key.split(".",1)
+    if len(keys) == 1:
+        config[key] = value
+    else:
+        config.setdefault(keys[0],{})[keys[1]] = value
+
+def sample_value(rng,dist):
+    if "choice" in dist:
+        return rng.choice(dist["choice"])
+    elif "uniform" in dist:
+        low,high = dist["uniform"]
+        return rng.uniform(low,high)
+    elif "log-uniform" in dist:
+        low,high = dist["log-uniform"]
+        return float(np.exp(rng.uniform(np.log(low),np.log(high))))
+    elif "int" in dist:
+        low,high = dist["int"]
+        return rng.randint(low,high)
+    else:
+        raise ValueError("No distribution.")
+
+def expand_spec(spec):
+    if "base" in spec:
+        base = spec["base"]
+    else:
+        from make_config import make_config_json
+        base = make_config_json()
+    grid = spec.get("grid",{})
+    grid_keys = list(grid.keys())
+    grid_points = [dict(zip(grid_keys,values)) for values in itertools.product(*[grid[k] for k in grid_keys])]
+
+    random_spec = dict(spec.get("random",{}))
+    samples = int(random_spec.pop("samples",1))
+    rng = random.Random(random_spec.pop("seed",0))
+    random_points = [{k:sample_value(rng,dist) for k,dist in random_spec.items()} for _ in range(samples)]
+
+    configs = []
+    for grid_point in grid_points:
+        for random_point in random_points:
+            config = copy.deepcopy(base)
+            for k,v in list(grid_point.items()) + list(random_point.items()):
+                set_value(config,k,v)
+            configs.append(config)
+    return configs
+
+def config_hash(config):
+    content = {k:v for k,v in config.items() if k not in EXECUTION_KEYS}
+    return hashlib.sha256(json.dumps(content,sort_keys = True).encode()).hexdigest()[:16]
+
+def write_atomic(path,content):
+    tmp_path = path + f".tmp{os.getpid()}"
+    with open(tmp_path,"w") as f:
+        json.dump(content,f,indent=4)
+    os.replace(tmp_path,path)
+
+def marker_path(config_name,ext):
+    # config と同じ場所の <hash>.started, <hash>.done
+    return os.path.join(CONFIGPATH,config_name[:-len(".json")] + ext)
+
+def clean_trials(config_name,config):
+    # 中断した config の途中までの試行と result.json の値を消す
+    trial_log = marker_path(config_name,".trials")
+    if not os.path.exists(trial_log):
+        return
+    savepath = get_savepath(config)
+    with open(trial_log) as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    for entry in entries:
+        if "suffix" in entry:
+            if not os.path.isdir(savepath):
+                continue
+            # 保存する値の名前に数字は含まれないので, suffix "1" が "fvalues11.pth" に当たることはない
+            for file_name in find_files(savepath,r"[a-z_]+" + re.escape(entry["suffix"]) + r"\.pth"):
+                if file_name != "solution.pth":
+                    os.remove(os.path.join(savepath,file_name))
+        else:
+            remove_result_json(os.path.join(savepath,"result.json"),entry["result"],entry["iteration"])
+    os.remove(trial_log)
+
+def start(config_name,config):
+    write_atomic(marker_path(config_name,".started"),config)
+
+def finish(config_name,config):
+    write_atomic(marker_path(config_name,".done"),config)
+    logger.info(f"done {config_name}")
+
+def fail(config_name,config,e):
+    logger.info(f"failed {config_name}:{e}")
+
+def run_job(config_names,threads):
+    # 同じ問題の config をまとめて run_many で実行する (データは一度だけ読み込む)
+    if threads is not None:
+        torch.set_num_threads(int(threads))
+    torch.seed()
+    np.random.seed()
+    run_many(config_names,on_start = start,on_finish = finish,on_error = fail)
+    return config_names
+
+def split_jobs(jobs,workers):
+    # (problem,properties) ごとにまとめ, 各まとまりを高々 workers 個に分ける
+    groups = {}
+    for config_name,config in jobs:
+        key = json.dumps([config["problem"],config["properties"]],sort_keys = True)
+        groups.setdefault(key,[]).append(config_name)
+    chunks = []
+    for config_names in groups.values():
+        n = min(workers,len(config_names))
+        size = -(-len(config_names)//n)
+        chunks += [config_names[i:i + size] for i in range(0,len(config_names),size)]
+    return chunks
+
+def run_sweep(spec):
+    name = spec.get("name","sweep")
+    workers = int(spec.get("workers",1))
+    threads = spec.get("threads",None)
+    sweep_dir = os.path.join(CONFIGPATH,SWEEPPATH,name)
+    os.makedirs(sweep_dir,exist_ok = True)
+
+    jobs = []
+    for config in expand_spec(spec):
+        h = config_hash(config)
+        config_name = os.path.join(SWEEPPATH,name,h + ".json")
+        if os.path.exists(marker_path(config_name,".done")):
+            continue
+        if os.path.exists(marker_path(config_name,".started")):
+            clean_trials(config_name,config)
+            os.remove(marker_path(config_name,".started"))
+        config = dict(config,trial_log = marker_path(config_name,".trials"))
+        write_atomic(os.path.join(sweep_dir,h + ".json"),config)
+        jobs.append((config_name,config))
+    logger.info(f"{len(jobs)} configs to run")
+
+    if workers == 1:
+        run_job([config_name for config_name,_ in jobs],threads)
+        return
+
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("fork" if "fork" in methods else "spawn")
+    with ProcessPoolExecutor(max_workers = workers,mp_context = context) as executor:
+        futures = {executor.submit(run_job,config_names,threads):config_names for config_names in split_jobs(jobs,workers)}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                # config ごとの例外は run_job の中で処理するので, ここに来るのは worker が落ちたときだけ
+                logger.info(f"failed {futures[future]}:{e}")
+
+if __name__ == "__main__":
+    args = sys.argv
+    with open(args[1]) as f:
+        spec = json.load(f)
+    run_sweep(spec)
@@ -1,7 +1,11 @@
 import torch
 from torch.autograd.functional import hvp
-from environments import DEVICE,DTYPE
+from environments import DEVICE,DTYPE,DATAPATH
 import numpy as np
+import os
+import json
+import shutil
+import hashlib
 
 def GetMinimumEig(H):
   eigenvalues = torch.linalg.eigvalsh(H)
@@ -24,6 +28,211 @@ def compute_min_eigen(matrix):
 def compute_hvp(func,x,v):
    return hvp(func,(x,),(v,))[1][0]
 
+def hvp_closure(loss,x):
+   # loss = func(x) から勾配を create_graph=True で一度だけ作り, v -> H v を返す (H は作らない)
+   g, = torch.autograd.grad(loss,x,create_graph = True)
+   def hvp_(v):
+      Hv, = torch.autograd.grad(g,x,grad_outputs = v,retain_graph = True)
+      return Hv.detach()
+   return g.detach(),hvp_
+
+def reduced_hessian(func,x,P,loss = None):
+   # P^T H P と勾配 g を返す. P の各列について forward-over-reverse (grad の jvp) を vmap で一度に計算し,
+   # 同じ計算から g も得る. vmap できない関数 (疎行列など) では勾配のグラフを一度だけ作り HVP を列ごとに計算する
+   try:
+      from torch.func import grad_and_value,jvp,vmap
+      gv = grad_and_value(func)
+      x_ = x.detach()
+      def hp(v):
+         (g,_),(Hv,_) = jvp(gv,(x_,),(v,))
+         return Hv,g
+      HP,G = vmap(hp)(P.transpose(0,1))
+      g = G[0]
+   except (RuntimeError,NotImplementedError,ImportError):
+      if loss is None:
+         loss = func(x)
+      g,hvp_ = hvp_closure(loss,x)
+      HP = torch.stack([hvp_(P[:,i]) for i in range(P.shape[1])])
+   PHP = HP@P
+   return g,(PHP + PHP.transpose(0,1))/2
+
+def lanczos_min_eig(hvp_,v0,iteration = 20,tol = 1e-10):
+   # Lanczos 法で H の最小固有値を推定する (HVP は iteration 回)
+   v = v0/torch.linalg.norm(v0)
+   v_prev = torch.zeros_like(v)
+   alphas = []
+   betas = []
+   beta = 0
+   for j in range(iteration):
+      w = hvp_(v)
+      alpha = w@v
+      w = w - alpha*v - beta*v_prev
+      alphas.append(alpha)
+      beta = torch.linalg.norm(w)
+      if beta < tol or j == iteration - 1:
+         break
+      betas.append(beta)
+      v_prev = v
+      v = w/beta
+   T = torch.diag(torch.stack(alphas))
+   if len(betas) > 0:
+      off = torch.stack(betas)
+      T = T + torch.diag(off,1) + torch.diag(off,-1)
+   return torch.linalg.eigvalsh(T)[0].item()
+
+def truncated_cg(hvp_,g,eps = 0,tol = 1e-6,iteration = 100):
+   # (H + 2 eps I) y = -g を CG で解く. p^T (H + 2 eps I) p <= eps \|p\|^2 となる方向が見つかれば
+   # 負の曲率方向として返す (capped CG の H のノルムの推定や残差の減少の判定は行わない).
+   # 戻り値 : (方向,"SOL" または "NC")
+   y = torch.zeros_like(g)
+   g_norm = torch.linalg.norm(g)
+   if g_norm == 0:
+      return y,"SOL"
+   r = g.clone()
+   p = -g
+   for j in range(iteration):
+      Hp = hvp_(p) + 2*eps*p
+      pHp = p@Hp
+      pp = p@p
+      if pHp <= eps*pp:
+         return p,"NC"
+      alpha = (r@r)/pHp
+      y = y + alpha*p
+      r1 = r + alpha*Hp
+      if torch.linalg.norm(r1) <= tol*g_norm:
+         return y,"SOL"
+      beta = (r1@r1)/(r@r)
+      p = -r1 + beta*p
+      r = r1
+   return y,"SOL"
+
+
+def file_hash(path):
+   # ファイルの中身の sha256 (サイズと更新時刻が同じなら DATAPATH/cache/hashes.json に保存した値を使う)
+   index_path = os.path.join(DATAPATH,"cache","hashes.json")
+   stat = os.stat(path)
+   key = os.path.abspath(path)
+   index = {}
+   if os.path.exists(index_path):
+      with open(index_path) as f:
+         index = json.load(f)
+   entry = index.get(key)
+   if entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+      return entry["hash"]
+   h = hashlib.sha256()
+   with open(path,"rb") as f:
+      for block in iter(lambda: f.read(1 << 20),b""):
+         h.update(block)
+   index[key] = {"size":stat.st_size,"mtime":stat.st_mtime_ns,"hash":h.hexdigest()}
+   os.makedirs(os.path.dirname(index_path),exist_ok = True)
+   tmp_path = index_path + f".tmp{os.getpid()}"
+   with open(tmp_path,"w") as f:
+      json.dump(index,f,indent=4)
+   os.replace(tmp_path,index_path)
+   return h.hexdigest()
+
+# 非零要素の割合がこれ以上なら密行列で持つ
+DENSE_DENSITY = 0.1
+
+def choose_layout(shape,nnz,layout = "auto"):
+   # データ行列の形式 ("dense","csr","csc","coo") を決める. auto なら非零要素の割合で dense か csr
+   if layout != "auto":
+      return layout
+   density = nnz/max(1,shape[0]*shape[1])
+   return "dense" if density >= DENSE_DENSITY else "csr"
+
+def set_layout(X,layout = "auto"):
+   # X を layout の形式に変換する
+   if X.layout == torch.sparse_coo:
+      X = X.coalesce()
+      nnz = X._nnz()
+   elif X.layout in (torch.sparse_csr,torch.sparse_csc):
+      nnz = X.values().shape[0]
+   else:
+      nnz = torch.count_nonzero(X).item()
+   layout = choose_layout(X.shape,nnz,layout)
+   if layout == "dense":
+      return X if X.layout == torch.strided else X.to_dense()
+   elif layout == "csr":
+      return X if X.layout == torch.sparse_csr else X.to_sparse_csr()
+   elif layout == "csc":
+      return X if X.layout == torch.sparse_csc else X.to_sparse_csc()
+   elif layout == "coo":
+      return X if X.layout == torch.sparse_coo else X.to_sparse().coalesce()
+   else:
+      raise ValueError("No layout.")
+
+def select_rows(X,index):
+   # X の行 index (重複してよい) を取り出す. CSR は crow_indices から直接組み立てる (CSC は先に CSR にしておく)
+   if X.layout == torch.sparse_csr:
+      crow = X.crow_indices()
+      start = crow[index]
+      counts = crow[index + 1] - start
+      crow_ = torch.zeros(index.shape[0] + 1,dtype = crow.dtype,device = crow.device)
+      crow_[1:] = torch.cumsum(counts,0)
+      # 取り出した行列の非零要素が元の values の何番目か
+      position = torch.arange(int(crow_[-1]),device = crow.device) + torch.repeat_interleave(start - crow_[:-1],counts)
+      return torch.sparse_csr_tensor(crow_,X.col_indices()[position],X.values()[position],size = (index.shape[0],X.shape[1]))
+   elif X.layout == torch.sparse_coo:
+      return torch.index_select(X,0,index)
+   elif X.layout == torch.sparse_csc:
+      raise ValueError("select_rows needs csr (or coo, dense).")
+   return X[index]
+
+def load_svmlight_cached(path_dataset,dtype = DTYPE,layout = "auto"):
+   # SVMlight ファイルを CSR (indptr,indices,data) と labels の .npy (dtype に変換済み) として
+   # DATAPATH/cache/<内容のhash>_<dtype> に保存し, 2回目からは mmap で読む. 戻り値は (X : layout の形式,y)
+   # layout : choose_layout を参照 (csr ならキャッシュの配列をそのまま使うのでコピーはない)
+   np_dtype = torch.empty(0,dtype = dtype).numpy().dtype
+   cache_dir = os.path.join(DATAPATH,"cache",file_hash(path_dataset) + "_" + str(np_dtype))
+   if not os.path.exists(cache_dir):
+      from sklearn.datasets import load_svmlight_file
+      X,y = load_svmlight_file(path_dataset,dtype = np_dtype)
+      X.sort_indices()
+      # 別の場所に書いてから rename するので, 途中で止まっても壊れたキャッシュは残らない
+      tmp_dir = cache_dir + f".tmp{os.getpid()}"
+      os.makedirs(tmp_dir,exist_ok = True)
+      np.save(os.path.join(tmp_dir,"indptr.npy"),X.indptr.astype(np.int64))
+      np.save(os.path.join(tmp_dir,"indices.npy"),X.indices.astype(np.int64))
+      np.save(os.path.join(tmp_dir,"data.npy"),X.data)
+      np.save(os.path.join(tmp_dir,"labels.npy"),y)
+      with open(os.path.join(tmp_dir,"meta.json"),"w") as f:
+         json.dump({"shape":list(X.shape),"path":path_dataset},f)
+      try:
+         os.replace(tmp_dir,cache_dir)
+      except OSError:
+         # 他のプロセスが先に作った
+         shutil.rmtree(tmp_dir,ignore_errors = True)
+   with open(os.path.join(cache_dir,"meta.json")) as f:
+      shape = json.load(f)["shape"]
+   # mmap_mode = "c" : 書き込み可能な (copy-on-write) mmap なので torch.from_numpy でコピーしない
+   data = torch.from_numpy(np.load(os.path.join(cache_dir,"data.npy"),mmap_mode = "c"))
+   y = torch.from_numpy(np.load(os.path.join(cache_dir,"labels.npy"),mmap_mode = "c"))
+   layout = choose_layout(shape,data.shape[0],layout)
+   if layout != "coo":
+      indptr = torch.from_numpy(np.load(os.path.join(cache_dir,"indptr.npy"),mmap_mode = "c"))
+      indices = torch.from_numpy(np.load(os.path.join(cache_dir,"indices.npy"),mmap_mode = "c"))
+      X = torch.sparse_csr_tensor(indptr,indices,data,size = shape)
+      return set_layout(X,layout),y
+   coo_path = os.path.join(cache_dir,"coo.npy")
+   if not os.path.exists(coo_path):
+      # COO の (行,列) も保存しておけば, 読み込むたびに作らずに済み複数のプロセスでページを共有できる
+      indptr = np.load(os.path.join(cache_dir,"indptr.npy"),mmap_mode = "r")
+      indices = np.load(os.path.join(cache_dir,"indices.npy"),mmap_mode = "r")
+      rows = np.repeat(np.arange(shape[0],dtype = np.int64),np.diff(indptr))
+      tmp_path = coo_path + f".tmp{os.getpid()}.npy"
+      np.save(tmp_path,np.stack((rows,indices)))
+      os.replace(tmp_path,coo_path)
+   coo = torch.from_numpy(np.load(coo_path,mmap_mode = "c"))
+   X = torch.sparse_coo_tensor(coo,data,size = shape,is_coalesced = True)
+   return X,y
+
+def load_tensor(path):
+   # データのテンソルを mmap で読む (ページはプロセス間で共有される). mmap できない古い形式なら普通に読む
+   try:
+      return torch.load(path,mmap = True)
+   except (RuntimeError,TypeError):
+      return torch.load(path)
 
 def generate_semidefinite(dim,rank):
    P = torch.randn(dim,rank,device = DEVICE)
@@ -55,11 +264,11 @@ def generate_fusedmatrix(dim):
 
 def convert_coo_torch(X):
     values = X.data
-    indices = np.vstack((X.row,X.col))
-    i = torch.LongTensor(indices)
-    v = torch.FloatTensor(values)
+    indices = np.vstack((X.row,X.col)).astype(np.int64)
+    i = torch.from_numpy(indices)
+    v = torch.from_numpy(values)
     shape = X.shape
-    return torch.sparse.FloatTensor(i,v,torch.Size(shape))
+    return torch.sparse_coo_tensor(i,v,size = shape)
 
 def generate_sparse_random(d,n,s,column_index = None,prob_vector = None):
    if isinstance(s,int):
@@ -75,12 +284,33 @@ def generate_sparse_random(d,n,s,column_index = None,prob_vector = None):
    values = (2*torch.bernoulli(prob_vector)-1)/s**0.5
    return torch.sparse_coo_tensor(indices = index, values = values,device = DEVICE)
 
-def generate_sub_orthogonal(reduced_dim,dim):
-   v = torch.randn(1,dim,device = DEVICE)
-   v/= torch.linalg.norm(v)
-   a = v.transpose(0,1)[:reduced_dim]
-   G = torch.eye(reduced_dim,dim,device = DEVICE)-2*a@v
-   return G
+class Householder:
+   # Householder 行列 H = I - 2vv^T (\|v\| = 1) の最初の rows 行. 行列は作らず i 行目 e_i - 2v_i v をその都度作る
+   def __init__(self,v,rows):
+      self.v = v
+      self.shape = (rows,v.shape[0])
+
+   @staticmethod
+   def random(rows,dim,device = DEVICE,dtype = DTYPE):
+      v = torch.randn(dim,device = device,dtype = dtype)
+      return Householder(v/torch.linalg.norm(v),rows)
+
+   def __getitem__(self,i):
+      row = -2*self.v[i]*self.v
+      row[i] += 1
+      return row
+
+   def __matmul__(self,x):
+      # H[:rows]@x
+      rows = self.shape[0]
+      return x[:rows] - 2*self.v[:rows]*(self.v@x)
+
+   def t_matmul(self,y):
+      # H[:rows]^T@y
+      rows = self.shape[0]
+      out = -2*(self.v[:rows]@y)*self.v
+      out[:rows] += y
+      return out
 
 
 def modifying_parameters(solver_name,reduced_dims,heuristic_intervals,sparsity,projection):